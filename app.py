@@ -1,11 +1,16 @@
 import numpy as np
 import io
-import base64
+import time
 
 # a few custom files are used here:
 import textdata
-from trmc_network import S11ghz
-from curvefit_ks import curve_fit
+import tdmsdata
+import dataproc
+import calstore
+import fitjob
+from batchfit import FREQ_SCALE
+from trmc_network import S11ghz,adaptive_grid
+import s11fit
 
 import streamlit as st
 import plotly.express as px
@@ -30,36 +35,30 @@ __version__ = 1.02
 
 
 
-def s11_func(freq_ghz,d1,d2,d_iris,loss_fac,copper_S,layer_t,layer_epsr,layer_sig,sub_t,sub_epsr,sub_sig):
-    # helper function for fitting
-    global s11
-    s11.d1 = d1 #first distance in mm, distance between sample and cavity end
-    s11.d2 = d2 # 'complementary' distance in mm
-    s11.d_iris=d_iris # iris diameter in mm
-    s11.loss_fac=loss_fac #copper loss adjustment 
-    s11.layer_t=layer_t # layer thickness in mm
-    s11.layer_epsr=layer_epsr #dieelectric constant layer
-    #s11.layer_sig = layer_sig # conductance layer S/m
-    s11.layer_sig = abs(layer_sig) # conductance layer S/m
-    s11.sub_t=sub_t # substrate thickness in mm
-    s11.sub_epsr=sub_epsr # substrate (quartz) epsr  
-    s11.sub_sig = abs(sub_sig)
-    s11.copper_S = abs(copper_S)
-    # return np.array([s11.calc(x) for x in freq_ghz]) # freq_ghz is an array! , non numpy version   
-    return s11.calc(freq_ghz) 
+@st.cache_data(max_entries=64)
+def model_curve(pvals,a,b,fmin,fmax,fstep,adaptive,max_points):
+    '''
+    the model curve on the plot grid for the parameter values pvals (order of JAC_PARAMS) and the
+    waveguide a,b. The cache is shared by all sessions, the least recently used entries are dropped.
+    '''
+    model = S11ghz()
+    model.a,model.b = a,b
+    fitf = s11fit.S11Fit(model)
+    if adaptive :
+        return adaptive_grid(lambda x: fitf.vfunc(x,pvals),fmin,fmax,max_points=max_points)
+    f = np.arange(fmin,fmax,fstep)
+    return f , fitf.vfunc(f,pvals)
 
 
-
-def download_link(xdata,ydata,params,fname,container,text='download'):
-
+@st.cache_data(max_entries=16)
+def download_text(xdata,ydata,params):
+    'the model curve as text file, generated only when the download is requested'
     s = '# trmcapp microwave cavity model\n# frequency in GHz\n'
     for p in params:
         s += f"# {p['name']} = {p['val']}, fixed = {p['fixed']}\n"
     for x,y in zip(xdata,ydata):
         s += f'{x:.6} {y:.6}\n'
-    bin_str = base64.b64encode(s.encode()).decode()
-    href = f'<a href="data:application/octet-stream;base64,{bin_str}" download="{fname}">{text}</a>'
-    container.write(href, unsafe_allow_html=True)
+    return s
 
 
 def show_help():
@@ -76,39 +75,86 @@ def show_source():
 
 def main():
 
+    def start_fit(info):
+        'starts the fit as background job, see fitjob'
+        xfit,yfit = extdata[:,0],extdata[:,1]
+        if session.fit_crop :
+            idx = dataproc.fit_window(xfit,yfit,n_widths=session.fit_widths)
+            xfit,yfit = xfit[idx],yfit[idx]
+        bounds = None
+        if session.multistart :
+            span = session.ms_span/100
+            bounds = {p['name']:(p['val']*(1-span),p['val']*(1+span)) for p in c.plist if not p['fixed'] and p['val'] != 0}
+        return fitjob.FitJob(c,xfit,yfit,bounds,n_starts=session.ms_starts,info=info).start()
+
+    def finish_fit(job):
+        'takes over the result of a finished fit job'
+        if job.status == 'ok' :
+            for p in job.cfit.plist:
+                c.set(p['name'],p['val'],p['fixed'])
+            session['fit_alternatives'] = job.alternatives
+            session['fit_report'] = job.cfit.report()
+            fit_result(job.info['key'] if session.use_store else None,job.info['dhash'])
+        elif job.status == 'cancelled' :
+            area_info.warning('fit cancelled')
+        else :
+            area_info.error('fit did fail!')
+
+    def fit_result(key=None,dhash=None):
+        'the fit curve and chisqr on all data points, the result is saved in the calibration store for a key'
+        session['fit_bootstrap'] = None
+        yfit = c.calc(extdata[:,0])  
+        session['fit_y'] = yfit
+        session['fit_chi2'] = ((yfit - extdata[:,1])**2).sum()        
+        if key is not None :
+            store.put(key,c.plist,session['fit_chi2'],dhash,len(extdata))
+        session['fit_done'] = True                                  
+
     def do_fit():
         if len(extdata) > 1: 
-            try:
-                c.fit(extdata[:,0],extdata[:,1])            
-                yfit = c.calc(extdata[:,0])  
-                session['fit_y'] = yfit
-                session['fit_chi2'] = ((yfit - extdata[:,1])**2).sum()        
-            except RuntimeError:
-                st.error('fit did fail!')
-            session['fit_done'] = True                                  
+            dhash = calstore.data_hash(extdata[:,0],extdata[:,1])
+            setup = calstore.fit_setup(session.fit_widths if session.fit_crop else None,
+                                       (session.ms_starts,session.ms_span) if session.multistart else None)
+            key = calstore.fit_key(dhash,c.plist,**setup) # the same key as batchfit and workflow
+            entry = store.get(key) if session.use_store else None
+            session['fit_cached'] = entry['time'] if entry is not None else None
+            if entry is not None : # fitted before with the same data and start values
+                calstore.apply(c,entry)
+                session['fit_alternatives'] = None
+                session['fit_report'] = None
+                fit_result()
+            else :
+                session['fit_job'] = start_fit({'key':key,'dhash':dhash})
         else : 
             session['fit_done'] = False   
 
+    def do_bootstrap():
+        xfit,yfit = extdata[:,0],extdata[:,1]
+        if session.fit_crop :
+            idx = dataproc.fit_window(xfit,yfit,n_widths=session.fit_widths)
+            xfit,yfit = xfit[idx],yfit[idx]
+        session['fit_bootstrap'] = c.bootstrap(xfit,yfit,n=session.bs_samples)['stderr']
+
     def do_kfac():         
-        if kfac_min:
-            k = y.argmin()
-            session['kfreq'] = f[k]        
+        s11fit.set_model(s11,c) # the current parameter values
         s11.layer_sig = kfac_sigma
+        session['resonance'] = s11.resonance(fmin,fmax)
+        if kfac_min:
+            session['kfreq'] = session['resonance']['f0']
         session['kfac'] = s11.kfactor(session['kfreq'],rel_change=0.01)         
 
     @st.cache_data()
-    def load_data(datastream):        
+    def load_data(datastream,tdms_sel=None):        
         if datastream is not None: # process uploaded file            
             datastream.seek(0)        
-            buf = datastream.read()
-            buf = io.BytesIO(buf)
-            stream = io.TextIOWrapper(buf)        
-            data = textdata.read_textdata(stream)
-            data = np.array(data['data']) 
-            if session.frequnit == "Hz" :
-                data[:,0] = data[:,0] / 1e9
-            elif session.frequnit == "MHz" :
-                data[:,0] = data[:,0] / 1e3            
+            if tdms_sel is not None : # (group,frequency channel,S11 channel,sweep,sweep_len)
+                data = tdmsdata.read_tdms(datastream,*tdms_sel)
+            else :
+                buf = datastream.read()
+                buf = io.BytesIO(buf)
+                stream = io.TextIOWrapper(buf)        
+                data = textdata.read_textarray(stream)['data']
+            data[:,0] *= FREQ_SCALE[session.frequnit] # as batchfit.read_curve, the same data hash for the calibration store
             return data  
         else : 
             return []        
@@ -116,27 +162,54 @@ def main():
     def reset_values():
         del session.app_init
 
+    def select_tdms(datastream,container):
+        chans = tdmsdata.list_channels(datastream)
+        group = container.selectbox('tdms group',list(chans))
+        names = chans[group]
+        waveform = '(waveform properties)'
+        fch = container.selectbox('frequency channel',[waveform] + names,index=1 if names else 0,
+                                  help='(waveform properties) : the frequencies from wf_start_offset and wf_increment of the S11 channel')
+        fch = None if fch == waveform else fch
+        sch = container.selectbox('S11 channel',names,index=min(1,len(names)-1))
+        sweep_len = container.number_input('points per sweep (0 : auto)',value=0,min_value=0,help='auto: from the frequency channel (restart of the frequencies) or the waveform properties')
+        sweep = container.number_input('sweep',value=0,min_value=0,help='sweep number for channels with several sweeps')
+        return (group,fch,sch,sweep,sweep_len or None)
+
    
     # set the order of gui elements by defining containers:
     lcol,rcol = st.columns((1,3))
     area_graph = rcol.container()
     area_info = lcol.container()
     area_kfac = st.container()    
-    datastream = lcol.file_uploader(f'ascii 2 column f in {session.frequnit}',help='ascii 2 column (f,S) tab data')    
+    datastream = lcol.file_uploader(f'ascii 2 column or tdms, f in {session.frequnit}',help='ascii 2 column (f,S) tab data or TDMS file')    
     
     area_control = st.container()                 
-    extdata = load_data(datastream)
+    tdms_sel = None
+    if datastream is not None and datastream.name.lower().endswith('.tdms'):
+        tdms_sel = select_tdms(datastream,lcol)
+    try:
+        extdata = load_data(datastream,tdms_sel)
+    except ValueError as e: # e.g. a tdms sweep that is not in the file
+        lcol.error(str(e))
+        st.stop()
+    job = session.get('fit_job')
+    if job is not None and not job.running :
+        finish_fit(job)
+        session['fit_job'] = job = None
     lcol.button('reset values',on_click=reset_values)
     if datastream:
-            btn_fit = lcol.button('fit model',on_click=do_fit)
+            btn_fit = lcol.button('fit model',on_click=do_fit,disabled=job is not None)
+            if job is not None :
+                lcol.button('cancel fit',on_click=job.cancel)
+            lcol.checkbox('multi-start fit',key='multistart',help='global fit: local fits from many starting points within +/- span around the current values of the free parameters')
     with area_control :                
         st.markdown('**parameters:**')
         session.plobj.create(c._plist[1:],st,format='%1.5g')
         c._calc_reduced()
         #session.cfit = c
-        f = np.arange(fmin,fmax,fstep)
-        y = c.calc(f)
-        download_link(f,y,c._plist[1:],'trmcapp.txt',area_info,'download ascii')
+        f,y = model_curve(tuple(c.plist_values),s11.a,s11.b,fmin,fmax,fstep,adaptive,max_points)
+        if area_info.button('prepare download',help='model curve as ascii file'):
+            area_info.download_button('download ascii',download_text(f,y,c.plist),file_name='trmcapp.txt')
 
     with area_kfac :        
         kfe = st.expander('k-factor calculation')
@@ -148,24 +221,63 @@ def main():
         kfac_sigma = kc[3].number_input('layer sigma [S/m]',value=0.1,format='%1.4f')        
         if btn_kfac:
             st.markdown(f'k-factor @{session.kfreq:1.4}GHz is : {session.kfac}')
+            r = session.resonance
+            st.markdown(f"resonance: f0 = {r['f0']:1.6}GHz, FWHM = {r['fwhm']*1e3:1.4}MHz, Q = {r['Q']:1.4}, R0 = {r['R0']:1.4}")
     
     fig = px.line(x=f,y=y,log_y=False,title='trmc resonance curve',labels={'x':'frequency GHz','y':'S11 reflectivity'},height=im_height,width=im_width)
          
+    xlim = None
     if len(extdata) > 1:                
-        fig.add_trace(go.Scatter(x=extdata[:,0], y=extdata[:,1],
+        # only the display is decimated (min/max per bucket), zooming in with the range slider shows more points
+        xd0,xd1 = float(extdata[:,0].min()),float(extdata[:,0].max())
+        xlim = rcol.slider('data display range [GHz]',xd0,xd1,(xd0,xd1),format='%1.4f')
+        if xlim != (xd0,xd1) :
+            fig.update_xaxes(range=xlim)
+        idx = dataproc.decimate(extdata[:,0],extdata[:,1],plot_points,xlim)
+        fig.add_trace(go.Scatter(x=extdata[idx,0], y=extdata[idx,1],
             mode='markers',
             name='data'),
                 )
+    if job is not None : # running fit: progress and the current fit curve
+        prog = job.progress()
+        area_info.info(f"fit running: {prog['n']} {'fits' if job.bounds else 'evaluations'}, chisqr = {prog['chi2']:1.3}")
+        area_info.write(prog['params'])
+        if prog['y'] is not None :
+            i = dataproc.decimate(job.xdata,prog['y'],plot_points,xlim)
+            fig.add_trace(go.Scatter(x=job.xdata[i], y=prog['y'][i],mode='lines',name='fit (running)'))
     if session['fit_done'] :                              
-        fig.add_trace(go.Scatter(x=extdata[:,0], y=session['fit_y'],
+        idx = dataproc.decimate(extdata[:,0],session['fit_y'],plot_points,xlim)
+        fig.add_trace(go.Scatter(x=extdata[idx,0], y=session['fit_y'][idx],
         mode='markers',
         name='fit'),
             )
         chisqr = session['fit_chi2']                      
         results = area_info.expander(f'fit results (chisqr = {chisqr:1.3})')
+        if session.get('fit_cached') :
+            results.write(f"stored calibration from {session['fit_cached']}")
         results.write(c.plist)
+        rep = session.get('fit_report')
+        if rep is not None :
+            results.write('standard errors:')
+            results.write({k:float(v) for k,v in rep['stderr'].items()})
+            if rep['corr'] is not None :
+                results.write('correlation matrix:')
+                results.write({n:{m:round(float(rep['corr'][i,k]),3) for k,m in enumerate(rep['names'])} for i,n in enumerate(rep['names'])})
+            if rep['warning'] :
+                results.warning(rep['warning'])
+            results.number_input('bootstrap samples',value=100,min_value=10,key='bs_samples')
+            results.button('bootstrap errors',on_click=do_bootstrap,help='refits of the model + resampled residuals (parallel), for non gaussian errors')
+            if session.get('fit_bootstrap') :
+                results.write('bootstrap standard errors:')
+                results.write({k:float(v) for k,v in session['fit_bootstrap'].items()})
+        if session.get('fit_alternatives') :
+            results.write('multi-start, best fits:')
+            results.write([{'chi2':r['chi2'],**r['params']} for r in session['fit_alternatives']])
     
     area_graph.plotly_chart(fig)            
+    if job is not None : # poll the fit job
+        time.sleep(0.3)
+        st.rerun()
    
     
 ##################### init sequence #########################
@@ -178,33 +290,35 @@ with st.sidebar :
     st.selectbox('data frequency units',['Hz','MHz','GHz'],index=1,key="frequnit")
     im_width = st.number_input('image width',value=800)
     im_height = st.number_input('image height',value=400)
+    plot_points = st.number_input('max plot points',value=4000,min_value=100,help='data and fit curves with more points are decimated for the display (min/max per bucket), the fit uses all points')
     param_cols = st.number_input('nr of parameter columns',value=2)
     btn_reset = st.button("reset",help="reset cache and return to default values")
     st.write('### resonance plot:')
     fmin = st.number_input('fmin',value=8.2,format='%1.4f')
     fmax = st.number_input('fmax',value=9.2,format='%1.4f')    
-    fstep = st.number_input('step',value=0.001,format='%1.4f')
+    adaptive = st.checkbox('adaptive grid',value=True,help='refine the frequency grid only where the curve bends (resonance)')
+    fstep = st.number_input('step',value=0.001,format='%1.4f',disabled=adaptive)
+    max_points = st.number_input('max points',value=2000,min_value=100,disabled=not adaptive)
+    st.write('### fit data:')
+    st.checkbox('crop to resonance',value=True,key='fit_crop',help='fit only the points within +/- n linewidths around the dip, the baseline is thinned out')
+    st.number_input('n linewidths',value=5.0,min_value=0.5,key='fit_widths')
+    st.write('### multi-start fit:')
+    st.number_input('starts',value=16,min_value=2,key='ms_starts')
+    st.number_input('span [%]',value=10.0,min_value=0.0,key='ms_span')
+    st.write('### calibration store:')
+    st.checkbox('reuse stored fits',value=True,key='use_store',help=f'fit results are saved in {calstore.STORE_DIR} and reused for the same data and start values')
 
 session.plobj = stp.paramlist(cols=param_cols)
+store = calstore.CalStore()
 
 if 'app_init' not in session or btn_reset:
     session['app_init'] = True
     s11 = S11ghz()
-    c = curve_fit(s11_func)
-    c.set('d1',35.825,True)
-    c.set('d2',11,True)
-    c.set('d_iris',9.6,False)
-    c.set('loss_fac',1e-7,False)
-    c.set('copper_S',5.5e7,True)
-    c.set('layer_t',0.001,True)
-    c.set('layer_epsr',1,True)
-    c.set('layer_sig',0,True)
-    c.set('sub_t',1,True)
-    c.set('sub_epsr',1,False)
-    c.set('sub_sig',0,True)
+    c = s11fit.new_fit(s11)
     session['s11'] = s11
     session['cfit'] = c
     session['fit_done'] = False        
+    session['fit_job'] = None
 else :
     s11 =  session['s11']
     c = session['cfit']
@@ -0,0 +1,220 @@
+'''
+headless batch fitting of many resonance curves with the cavity model
+
+all files are fitted with the same start parameters and fixed/free mask,
+the fits are distributed over a process pool (one worker per cpu core by default)
+
+usage:
+python batchfit.py data_dir --unit MHz --free d_iris,loss_fac,sub_epsr --set sub_t=1.1 -o results.txt
+'''
+import os
+import pathlib
+import concurrent.futures
+import numpy as np
+
+import textdata
+import dataproc
+import calstore
+import s11fit
+from curvefit_ks import fit_global
+
+FREQ_SCALE = {'Hz':1e-9,'MHz':1e-3,'GHz':1.0} # data frequency unit -> GHz
+
+
+def read_curve(fname,frequnit='GHz',german_num=False):
+    'reads a 2 column resonance curve file, returns the (N x 2) array with the frequency in GHz'
+    data = textdata.read_textarray(fname,german_num=german_num)['data']
+    data[:,0] *= FREQ_SCALE[frequnit]
+    return data
+
+
+def fit_file(fname,plist,frequnit='GHz',german_num=False,window=None,store=None,**fitargs):
+    '''
+    fits a single resonance curve file
+    plist : list of {'name','val','fixed'} dicts with the start values (curve_fit.plist)
+    window : fit only the points within +/- window linewidths around the resonance (dataproc.fit_window)
+    store : directory of a calibration store (calstore.CalStore), curves fitted before with the same
+            start values and settings are not fitted again
+    returns a dict with 'file','status','chi2','n', the fitted parameter values and the standard errors
+    of the free parameters ('<name>_err', 'cond' and 'warning', see curvefit_ks.fit_report; NaN for stored fits)
+    '''
+    c = s11fit.new_fit()
+    for p in plist:
+        c.set(p['name'],p['val'],p['fixed'])
+    res = {'file':str(fname),'status':'ok','chi2':np.nan,'n':0}
+    rep = None
+    try:
+        data = read_curve(fname,frequnit,german_num)
+    except (OSError,ValueError,IndexError) as e:
+        data = None
+        res['status'] = f'read error: {e}'
+    if data is not None :
+        res['n'] = len(data)
+        try:
+            entry = None
+            if store is not None :
+                cs = calstore.CalStore(store)
+                dhash = calstore.data_hash(data[:,0],data[:,1])
+                key = calstore.fit_key(dhash,c.plist,**calstore.fit_setup(window,**fitargs))
+                entry = cs.get(key)
+            if entry is not None :
+                calstore.apply(c,entry)
+                res['chi2'] = entry['chi2']
+                res['status'] = 'stored'
+            else :
+                sel = slice(None) if window is None else dataproc.fit_window(data[:,0],data[:,1],n_widths=window)
+                c.fit(data[:,0][sel],data[:,1][sel],**fitargs)
+                res['chi2'] = ((c.calc(data[:,0]) - data[:,1])**2).sum()
+                rep = c.report()
+                if store is not None :
+                    cs.put(key,c.plist,res['chi2'],dhash,len(data),file=str(fname))
+        except RuntimeError:
+            res['status'] = 'fit did fail!'
+        except (ValueError,IndexError) as e: # e.g. nan or inf in the data
+            res['status'] = f'fit error: {e}'
+        except OSError as e:
+            res['status'] = f'store error: {e}'
+    for p in c.plist:
+        res[p['name']] = p['val']
+    res.update(_error_columns(plist,rep))
+    return res
+
+
+def _error_columns(plist,rep):
+    'standard error columns for the free parameters of plist, the same columns for all files'
+    cols = {f"{p['name']}_err":np.nan for p in plist if not p['fixed']}
+    cols.update({'cond':np.nan,'warning':None})
+    if rep is not None :
+        for name,err in rep['stderr'].items():
+            cols[f'{name}_err'] = err
+        cols.update({'cond':rep['cond'],'warning':rep['warning']})
+    return cols
+
+
+def _fit_job(job):
+    'internal helper for the process pool'
+    fname,plist,frequnit,german_num,window,store,fitargs = job
+    return fit_file(fname,plist,frequnit,german_num,window,store,**fitargs)
+
+
+def batch_fit(files,plist,frequnit='GHz',german_num=False,window=None,processes=None,store=None,**fitargs):
+    '''
+    fits all files in parallel with the same start parameters plist (see fit_file)
+    processes : number of worker processes, default is the number of cpu cores
+    returns the list of result dicts in the order of files
+    '''
+    jobs = [(f,plist,frequnit,german_num,window,store,fitargs) for f in files]
+    if processes is None :
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(jobs) < 2 :
+        return [_fit_job(j) for j in jobs]
+    chunk = max(1,len(jobs) // (4*processes))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as ex :
+        return list(ex.map(_fit_job,jobs,chunksize=chunk))
+
+
+def global_fit(files,plist,shared,frequnit='GHz',german_num=False,window=None,**fitargs):
+    '''
+    joint fit of all files: the parameters in shared (e.g. loss_fac,d_iris) are common to all curves,
+    the other unfixed parameters of plist are fitted per curve (curvefit_ks.fit_global)
+    returns the list of result dicts in the order of files (see fit_file), the standard errors are the ones of the joint fit.
+    Files that can not be read or contain nan/inf values are left out of the joint fit (status 'read error'/'fit error').
+    '''
+    plist = [dict(p,fixed=p['fixed'] and p['name'] not in shared) for p in plist]
+    fits,data,full,results = [],[],[],[]
+    for fname in files:
+        c = s11fit.new_fit()
+        for p in plist:
+            c.set(p['name'],p['val'],p['fixed'])
+        res = {'file':str(fname),'status':'ok','chi2':np.nan,'n':0}
+        d = None
+        try:
+            d = read_curve(fname,frequnit,german_num)
+            res['n'] = len(d)
+        except (OSError,ValueError,IndexError) as e:
+            res['status'] = f'read error: {e}'
+        if d is not None :
+            try:
+                if not np.all(np.isfinite(d)) :
+                    raise ValueError('nan or inf in the data')
+                sel = slice(None) if window is None else dataproc.fit_window(d[:,0],d[:,1],n_widths=window)
+                data.append((d[:,0][sel],d[:,1][sel]))
+            except (ValueError,IndexError) as e:
+                res['status'] = f'fit error: {e}'
+                d = None
+        fits.append(c)
+        full.append(d)
+        results.append(res)
+    ok = [k for k,d in enumerate(full) if d is not None]
+    if ok :
+        try:
+            fit_global([fits[k] for k in ok],data,shared,**fitargs)
+        except (RuntimeError,ValueError) as e:
+            for k in ok:
+                results[k]['status'] = f'fit error: {e}'
+    for r,c,d in zip(results,fits,full):
+        if d is not None :
+            r['chi2'] = ((c.calc(d[:,0]) - d[:,1])**2).sum()
+        for p in c.plist:
+            r[p['name']] = p['val']
+        r.update(_error_columns(plist,c.report()))
+    return results
+
+
+def write_table(results,fname):
+    'writes the batch results as tab separated text table, one row per file'
+    if not results :
+        return
+    cols = list(results[0].keys())
+    with open(fname,'wt') as fp :
+        fp.write('# trmcapp batch fit results\n')
+        fp.write('\t'.join(cols) + '\n')
+        for r in results:
+            fp.write('\t'.join(str(r[k]) for k in cols) + '\n')
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    ap = argparse.ArgumentParser(description='batch fit of TRMC cavity resonance curves')
+    ap.add_argument('path',nargs='+',help='data files or directories')
+    ap.add_argument('--pattern',default='*.txt',help='file pattern for directories')
+    ap.add_argument('--unit',default='GHz',choices=list(FREQ_SCALE),help='frequency unit of the data')
+    ap.add_argument('--german',action='store_true',help='decimal comma')
+    ap.add_argument('--free',default=None,help='comma separated list of the fitted parameters, default as in the app')
+    ap.add_argument('--set',nargs='*',default=[],help='start values as name=value')
+    ap.add_argument('--shared',default=None,help='comma separated list of parameters common to all files (joint fit of all files)')
+    ap.add_argument('--window',type=float,default=None,help='fit only +/- WINDOW linewidths around the resonance')
+    ap.add_argument('--store',nargs='?',default=None,const=str(calstore.STORE_DIR),help='reuse and save the fits in a calibration store (directory)')
+    ap.add_argument('-j','--processes',type=int,default=None,help='number of worker processes')
+    ap.add_argument('-o','--out',default='batchfit.txt',help='result table')
+    args = ap.parse_args()
+
+    files = []
+    for x in args.path:
+        x = pathlib.Path(x)
+        files += sorted(x.glob(args.pattern)) if x.is_dir() else [x]
+
+    plist = s11fit.new_fit().plist
+    for s in args.set:
+        name,val = s.split('=')
+        for p in plist:
+            if p['name'] == name :
+                p['val'] = float(val)
+                break
+        else : assert 0,f'parameter <{name}> not found'
+    if args.free is not None :
+        free = args.free.split(',')
+        for p in plist:
+            p['fixed'] = p['name'] not in free
+
+    import time
+    t0 = time.perf_counter()
+    if args.shared is not None :
+        results = global_fit(files,plist,args.shared.split(','),args.unit,args.german,args.window)
+    else :
+        results = batch_fit(files,plist,args.unit,args.german,args.window,args.processes,args.store)
+    write_table(results,args.out)
+    nok = sum(r['status'] in ('ok','stored') for r in results)
+    print(f'{len(results)} files, {nok} fits ok, {time.perf_counter()-t0:1.2f}s -> {args.out}')
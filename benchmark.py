@@ -0,0 +1,151 @@
+'''
+benchmarks of the cavity model, the fitter and the data file reader
+
+the results (seconds per call, best of several repeats) are saved as json, so that
+different versions can be compared. With --baseline the results are compared to a
+stored result file and all cases that are slower by more than --threshold percent
+are reported as regressions (exit code 1).
+
+usage:
+python benchmark.py -o bench_new.json
+python benchmark.py -o bench_new.json --baseline bench_old.json --threshold 20
+python benchmark.py --quick                     # smaller sizes, for a fast check
+'''
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import tempfile
+import numpy as np
+
+import textdata
+import s11fit
+from trmc_network import S11ghz,S11ghz_Ka
+
+X_BAND = (8.2,9.2) # GHz, resonance of the default cavity
+KA_BAND = (24.9,25.9) # GHz, resonance of the S11ghz_Ka cavity
+# free parameters of the fit cases per band, in the Ka band cavity (d1 = 1 mm) d1 and sub_epsr can not be fitted together
+FIT_MASKS = {'x':('d_iris,loss_fac','d_iris,loss_fac,sub_epsr','d1,d_iris,loss_fac,sub_epsr'),
+             'ka':('d_iris,loss_fac','d_iris,loss_fac,sub_epsr','d1,d_iris,loss_fac')}
+
+
+def _time(func,min_time=0.2,repeat=5):
+    'best time per call in s, each repeat runs func for at least min_time'
+    t = timeit.Timer(func)
+    n,dt = t.autorange()
+    if dt < min_time :
+        n = max(1,int(n*min_time/dt))
+    return min(t.repeat(repeat=repeat,number=n)) / n
+
+
+def _fit_case(model,band,mask,n=2001):
+    '''
+    returns a function that fits synthetic data of model in band with the free parameters mask,
+    only the free parameters differ from the start values. The fit is checked to recover them first,
+    so that only converged fits are timed.
+    '''
+    free = mask.split(',')
+    c = s11fit.new_fit(model)
+    for name in ('d1','d2','d_iris','loss_fac'):
+        c.set(name,getattr(model,name))
+    c.set('sub_epsr',3.5)
+    for p in c.plist:
+        c.set(p['name'],p['val'],p['name'] not in free)
+    truth = {'d_iris':model.d_iris*1.01,'loss_fac':model.loss_fac*1.2,'sub_epsr':3.6,'d1':model.d1+0.01}
+    x = np.linspace(band[0],band[1],n)
+    ref = c.copy()
+    for name in free:
+        ref.set(name,truth[name])
+    y = ref.calc(x)
+    test = c.copy()
+    try:
+        test.fit(x,y)
+    except RuntimeError as e:
+        assert 0,f'fit case {mask}: {e}'
+    for name in free:
+        assert abs(getattr(test,name)/truth[name] - 1) < 1e-4,f'fit case {mask}: {name} = {getattr(test,name)} instead of {truth[name]}'
+    def run():
+        c.copy().fit(x,y)
+    return run
+
+
+def _text_file(n,fname):
+    'writes a 2 column text file with a header and n rows'
+    x = np.linspace(8e3,9e3,n)
+    y = 1 - 0.5/(1+((x-8.5e3)/10)**2)
+    np.savetxt(fname,np.c_[x,y],delimiter='\t',header='frequency\tS11\nsynthetic resonance')
+
+
+def run_all(quick=False):
+    'runs all benchmarks, returns {case name : seconds per call}'
+    res = {}
+    s = S11ghz()
+    for n in (101,1001,10001) if quick else (101,1001,10001,100001):
+        f = np.linspace(*X_BAND,n)
+        res[f'calc_{n}'] = _time(lambda: s.calc(f)) # repeated calls on the same array: FreqCache hits
+        res[f'calc_uncached_{n}'] = _time(lambda: s.calc(f.copy())) # a new frequency array every call
+        if n <= 10001 :
+            res[f'calc_nonumpy_{n}'] = _time(lambda: [s._calc_nonumpy(x) for x in f],repeat=3) # scalar only
+    f = np.linspace(*X_BAND,2001)
+    ts = np.linspace(0.5,1.5,50 if quick else 500)
+    for prec in ('double','single'):
+        res[f'sweep_{prec}_{len(ts)}x{len(f)}'] = _time(lambda: s.sweep(f,precision=prec,sub_t=ts),repeat=3)
+    f0 = s.resonance(*X_BAND)['f0']
+    res['kfactor'] = _time(lambda: s.kfactor(f0))
+
+    for band,model,tag in ((X_BAND,S11ghz(),'x'),(KA_BAND,S11ghz_Ka(),'ka')):
+        for mask in FIT_MASKS[tag][:2] if quick else FIT_MASKS[tag]:
+            res[f"fit_{tag}_{mask.replace(',','+')}"] = _time(_fit_case(model,band,mask),min_time=0.5,repeat=3)
+
+    with tempfile.TemporaryDirectory() as tmp :
+        for n in (1000,10000,100000) if quick else (1000,10000,100000,1000000):
+            fname = os.path.join(tmp,f'data_{n}.txt')
+            _text_file(n,fname)
+            res[f'read_textdata_{n}'] = _time(lambda: textdata.read_textdata(fname),min_time=0.1,repeat=3)
+            res[f'read_textarray_{n}'] = _time(lambda: textdata.read_textarray(fname),min_time=0.1,repeat=3)
+    return res
+
+
+def compare(res,base,threshold=20):
+    'returns [(case,base time,new time,ratio)] for all cases slower than base by more than threshold %'
+    slow = []
+    for k,t in res.items():
+        if k in base and t > base[k]*(1 + threshold/100) :
+            slow.append((k,base[k],t,t/base[k]))
+    return slow
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    ap = argparse.ArgumentParser(description='benchmarks of the trmcapp model, fitter and file reader')
+    ap.add_argument('-o','--out',default=None,help='save the results as json')
+    ap.add_argument('--baseline',default=None,help='json result file to compare with')
+    ap.add_argument('--threshold',type=float,default=20,help='regression threshold in percent')
+    ap.add_argument('--quick',action='store_true',help='smaller sizes')
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    res = run_all(args.quick)
+    for k,t in res.items():
+        print(f'{k:40} {t*1e3:12.4f} ms')
+    print(f'total {time.perf_counter()-t0:1.1f}s')
+
+    if args.out is not None :
+        meta = {'time':time.strftime('%Y-%m-%d %H:%M:%S'),'python':platform.python_version(),
+                'numpy':np.__version__,'machine':platform.machine(),'processor':platform.processor()}
+        with open(args.out,'wt') as fp :
+            json.dump({'meta':meta,'results':res},fp,indent=1)
+
+    if args.baseline is not None :
+        with open(args.baseline,'rt') as fp :
+            base = json.load(fp)['results']
+        slow = compare(res,base,args.threshold)
+        for k,tb,tn,r in slow:
+            print(f'REGRESSION {k}: {tb*1e3:1.4f} ms -> {tn*1e3:1.4f} ms ({(r-1)*100:+1.0f}%)')
+        if slow :
+            sys.exit(1)
+        print(f'no regressions > {args.threshold}% against {args.baseline}')
@@ -0,0 +1,124 @@
+'''
+persistent store of fitted cavity calibrations (empty cavity, substrate ...)
+
+a fit result is saved as small json file in the store directory. The key is a hash of the
+data (frequency and S11 values), the start parameters with their fixed flags and the fit
+settings, so a curve that was fitted before with the same setup is recognized by its content
+and the stored result is returned instead of refitting.
+'''
+import json
+import time
+import hashlib
+import pathlib
+import tempfile
+import numpy as np
+
+STORE_DIR = pathlib.Path.home() / '.trmcapp' / 'calibrations'
+
+
+def data_hash(x,y):
+    'content hash (hex string) of a resonance curve'
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(x,dtype=float).tobytes())
+    h.update(np.ascontiguousarray(y,dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def fit_setup(window=None,multistart=None,**fitargs):
+    '''
+    the fit settings for fit_key, the same schema is used by the app, batchfit and workflow,
+    so that a calibration fitted by one of them is found by the others
+    window : +/- linewidths of the fit window (dataproc.fit_window), None for all points
+    multistart : (n_starts,span) of a multi-start fit, None (not part of the key) for a single fit
+    fitargs : other arguments of curve_fit.fit
+    '''
+    setup = {'window':None if window is None else float(window),**fitargs}
+    if multistart is not None :
+        setup['multistart'] = [float(v) for v in multistart]
+    return setup
+
+
+def fit_key(dhash,plist,**setup):
+    '''
+    key of a fit: data hash, start values and fixed flags of plist ({'name','val','fixed'} dicts)
+    and the fit settings setup (see fit_setup)
+    '''
+    start = [(p['name'],float(p['val']),bool(p['fixed'])) for p in plist]
+    s = json.dumps({'data':dhash,'start':start,'setup':setup},sort_keys=True,default=str)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+class CalStore():
+    '''
+    calibration store in the directory path, one json file per key:
+    {'plist','chi2','data_hash','n','time', ...}
+    '''
+    def __init__(self,path=STORE_DIR):
+        self.path = pathlib.Path(path)
+
+    def _fname(self,key):
+        return self.path / f'{key}.json'
+
+    def get(self,key):
+        'returns the stored entry for key or None'
+        try:
+            with open(self._fname(key),'rt') as fp :
+                return json.load(fp)
+        except (OSError,ValueError):
+            return None
+
+    def put(self,key,plist,chi2,dhash,n,**info):
+        'stores the fitted plist with chi2 and the data fingerprint (hash, number of points)'
+        entry = {'plist':[{'name':p['name'],'val':float(p['val']),'fixed':bool(p['fixed'])} for p in plist],
+                 'chi2':float(chi2),'data_hash':dhash,'n':int(n),'time':time.strftime('%Y-%m-%d %H:%M:%S'),**info}
+        self.path.mkdir(parents=True,exist_ok=True)
+        # a unique temporary file per writer, the rename replaces the entry as a whole,
+        # so parallel writers of the same key never leave half written entries
+        with tempfile.NamedTemporaryFile('wt',dir=self.path,prefix=f'{key}.',suffix='.tmp',delete=False) as fp :
+            json.dump(entry,fp,indent=1)
+        pathlib.Path(fp.name).replace(self._fname(key))
+        return entry
+
+    def find(self,dhash):
+        'all entries for the data hash dhash (fits with different setups), newest first'
+        res = []
+        for f in self.path.glob('*.json'):
+            e = self.get(f.stem)
+            if e is not None and e.get('data_hash') == dhash :
+                res.append(e)
+        return sorted(res,key=lambda e: e['time'],reverse=True)
+
+    def clear(self):
+        for f in self.path.glob('*.json'):
+            f.unlink()
+
+
+def apply(c,entry):
+    'sets the stored parameter values and fixed flags in the curve_fit object c'
+    for p in entry['plist']:
+        c.set(p['name'],p['val'],p['fixed'])
+
+
+if __name__ == "__main__":
+
+    import s11fit
+
+    c = s11fit.new_fit()
+    x = np.linspace(8.2,9.2,2001)
+    c.set('d_iris',9.5)
+    y = c.calc(x)
+    c.set('d_iris',9.6)
+
+    with tempfile.TemporaryDirectory() as tmp :
+        store = CalStore(tmp)
+        dh = data_hash(x,y)
+        key = fit_key(dh,c.plist,**fit_setup())
+        for k in range(2): # the second pass reads the stored result
+            t0 = time.perf_counter()
+            e = store.get(key)
+            if e is None :
+                c.fit(x,y)
+                e = store.put(key,c.plist,((c.calc(x)-y)**2).sum(),dh,len(x))
+            else :
+                apply(c,e)
+            print(f"{time.perf_counter()-t0:1.4f}s d_iris = {c.d_iris}, chi2 = {e['chi2']:1.3g}")
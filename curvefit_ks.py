@@ -1,6 +1,10 @@
 from fixparameter import fixparameter
+import os
+import concurrent.futures
 import numpy as np
 import scipy.optimize as opt
+import scipy.sparse as sparse
+from scipy.stats import qmc
 from copy import deepcopy
 
 class curve_fit(fixparameter):
@@ -8,9 +12,60 @@ class curve_fit(fixparameter):
     curve_fit is an interface to scipy.opt.curve_fit that enables a more
     convinient handling of the fit parameter, including fixing parameters
     '''
-    def __init__(self,func): # func is required!
+    def __init__(self,func,jac=None,vfunc=None,vjac=None): # func is required!
+        '''
+        jac : optional function with the signature of func plus a keyword argument 'free'.
+              It returns the derivatives of func as array (len(xdata) x len(free)),
+              one column for each parameter name in free (the unfixed parameters)
+        vfunc,vjac : optional vector versions of func and jac used in the fit loop,
+              vfunc(xdata,pvec) and vjac(xdata,pvec,free) with pvec the array of all parameters
+              of func after xdata. They must not keep a reference to pvec.
+        '''
         super().__init__(func)
+        self._jac = jac
+        self._vfunc = vfunc
+        self._vjac = vjac
+        self._report = None
+
+    def jac(self,*args):
+        'jacobian of the reduced function (unfixed parameters only)'
+        free = [p['name'] for p in super().plist[1:] if not p['fixed']]
+        return( self._jac(*self._fullargs(args),free=free) )
     
+    def _compiled(self):
+        '''
+        fit function and jacobian for the fit loop: the fixed values are copied once into a
+        preallocated parameter vector, each call only writes the unfixed values at the precomputed
+        positions and calls vfunc/vjac (or func/jac with the vector as arguments)
+        '''
+        p = super().plist
+        idx = [i-1 for i in self._free[1:]] # positions in the parameter vector, xdata is always unfixed
+        free = [p[i+1]['name'] for i in idx]
+        if self._vfunc is not None :
+            pvec = np.array([x['val'] for x in p[1:]],dtype=float)
+            vidx = np.array(idx,dtype=int)
+            def func(x,*args):
+                pvec[vidx] = args
+                return( self._vfunc(x,pvec) )
+        else : # a list is faster for the argument unpacking
+            pvec = [x['val'] for x in p[1:]]
+            def func(x,*args):
+                for i,v in zip(idx,args):
+                    pvec[i] = v
+                return( self._func(x,*pvec) )
+        jac = None
+        if self._vjac is not None and self._vfunc is not None :
+            def jac(x,*args):
+                pvec[vidx] = args
+                return( self._vjac(x,pvec,free) )
+        elif self._jac is not None :
+            jvec = [x['val'] for x in p[1:]]
+            def jac(x,*args):
+                for i,v in zip(idx,args):
+                    jvec[i] = v
+                return( self._jac(x,*jvec,free=free) )
+        return func , jac
+
     def calc(self,xdata):
         x = super().plist
         x[0]['val'] = xdata
@@ -18,22 +73,93 @@ class curve_fit(fixparameter):
         y = super().func(*x)
         return(y)
     
-    def fit(self,xdata,ydata,sigma=None,absolute_sigma=False,method=None,bounds=(-np.inf,np.inf),maxfev=600,**kwargs):
+    def fit(self,xdata,ydata,sigma=None,absolute_sigma=False,method=None,bounds=(-np.inf,np.inf),maxfev=600,callback=None,**kwargs):
         # method{‘lm’, ‘trf’, ‘dogbox’}, optional
+        # callback(free parameter values,model values) is called after each evaluation of the fit function,
+        # an exception raised in callback stops the fit
         
         p = super().plist
         p[0]['val'] = xdata
         p[0]['fixed'] = False
+        self._calc_reduced()
         p = super().predlist
-        params, err_est = opt.curve_fit(super().func, xdata, ydata,p[1:],
+        func,jac = self._compiled()
+        if callback is not None :
+            fit_func = func
+            def func(x,*args):
+                y = fit_func(x,*args)
+                callback(args,y)
+                return( y )
+        if jac is not None and 'jac' not in kwargs:
+            kwargs['jac'] = jac
+        params, err_est = opt.curve_fit(func, xdata, ydata,p[1:],
             sigma=sigma,absolute_sigma=absolute_sigma,method=method,maxfev=maxfev,bounds=bounds,**kwargs)
         k = 0
         for x in super().plist[1:]:
             if not x['fixed']:
                 x['val'] = params[k]
                 k += 1        
+        self._report = fit_report([x['name'] for x in super().plist[1:] if not x['fixed']],err_est)
         return params, err_est
+
+    def report(self):
+        'uncertainties of the last fit (see fit_report), None before the first fit'
+        return( self._report )
+
+    def bootstrap(self,xdata,ydata,n=100,workers=None,seed=None,**kwargs):
+        '''
+        residual bootstrap around the current (fitted) parameters for non gaussian errors:
+        n fits of model + resampled residuals, started from the current values
+        workers : number of worker processes, see fit_multistart
+        returns {'stderr' : {name : standard deviation},'samples' : array (n x free parameters),'names'}
+        '''
+        rng = np.random.default_rng(seed)
+        ymod = self.calc(xdata)
+        res = ydata - ymod
+        jobs = [(self,xdata,ymod + rng.choice(res,len(res)),{},kwargs) for k in range(n)]
+        results = _run_starts(jobs,workers)
+        names = [p['name'] for p in self.plist if not p['fixed']]
+        samples = np.array([[r['params'][k] for k in names] for r in results if r['status'] == 'ok']).reshape(-1,len(names))
+        err = samples.std(axis=0,ddof=1) if len(samples) > 1 else np.full(len(names),np.nan) # nan if less than 2 fits did succeed
+        return {'stderr':dict(zip(names,err)),'samples':samples,'names':names}
     
+    def fit_multistart(self,xdata,ydata,bounds,n_starts=16,sampling='lhs',workers=None,seed=None,callback=None,**kwargs):
+        '''
+        global fit: runs the local fit from many starting points and keeps the best result
+        bounds : {name : (low,high)} start value range of unfixed parameters, the other
+                 unfixed parameters start at their current value
+        n_starts : number of starting points (for sampling='grid' rounded to a full grid)
+        sampling : 'lhs' latin hypercube or 'grid'
+        workers : number of worker processes for the local fits, default is the number of cpu cores,
+                  1 runs all fits in this process. The fit function must be picklable.
+        callback : callback(result) is called for each finished fit, an exception raised in callback
+                   stops the remaining fits
+        kwargs : passed to fit()
+        returns a list of {'chi2','status','start','params'} dicts of all fits, best first.
+        The parameters of the best fit are set as current values.
+        '''
+        names = list(bounds.keys())
+        for name in names:
+            k = self._findme(name)
+            assert k > 0 and not super().plist[k]['fixed'],f'parameter <{name}> is not a free parameter'
+        lo = np.array([bounds[k][0] for k in names],dtype=float)
+        hi = np.array([bounds[k][1] for k in names],dtype=float)
+        if sampling == 'grid' :
+            n = max(2,int(round(n_starts**(1/max(1,len(names))))))
+            axes = [np.linspace(0,1,n)]*len(names)
+            u = np.stack(np.meshgrid(*axes,indexing='ij'),axis=-1).reshape(-1,len(names))
+        else :
+            u = qmc.LatinHypercube(d=max(1,len(names)),seed=seed).random(n_starts)[:,:len(names)]
+        starts = [dict(zip(names,lo + x*(hi-lo))) for x in u]
+        jobs = [(self,xdata,ydata,start,kwargs) for start in starts]
+        results = _run_starts(jobs,workers,callback)
+        results.sort(key=lambda r: r['chi2'])
+        if results[0]['status'] == 'ok' :
+            for name,val in results[0]['params'].items():
+                self.set(name,val)
+            self._report = results[0]['report']
+        return results
+
     @property
     def plist(self):        
         return(super().plist[1:])
@@ -54,8 +180,150 @@ class curve_fit(fixparameter):
                 s += f"{k:5} = {v}\n"
             s += '\n'
         return(s)
+
+
+def _fit_start(job):
+    'internal helper for curve_fit.fit_multistart: a single local fit from a starting point'
+    cfit,xdata,ydata,start,kwargs = job
+    c = cfit.copy()
+    for name,val in start.items():
+        c.set(name,val)
+    res = {'chi2':np.inf,'status':'ok','start':start}
+    try:
+        c.fit(xdata,ydata,**kwargs)
+        res['chi2'] = ((c.calc(xdata) - ydata)**2).sum()
+    except (RuntimeError,ValueError) as e:
+        res['status'] = f'fit did fail: {e}'
+    res['params'] = {p['name']:p['val'] for p in c.plist if not p['fixed']}
+    res['report'] = c.report()
+    return res
+
+
+def _run_starts(jobs,workers=None,callback=None):
+    'internal helper: runs the _fit_start jobs in a process pool, callback(result) for each finished fit'
+    if workers is None :
+        workers = os.cpu_count() or 1
+    results = []
+    if workers == 1 or len(jobs) < 2 :
+        for j in jobs:
+            results.append(_fit_start(j))
+            if callback is not None :
+                callback(results[-1])
+    else :
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers,len(jobs))) as ex :
+            futures = [ex.submit(_fit_start,j) for j in jobs]
+            try:
+                for fu in concurrent.futures.as_completed(futures):
+                    results.append(fu.result())
+                    if callback is not None :
+                        callback(results[-1])
+            except BaseException:
+                for fu in futures:
+                    fu.cancel()
+                raise
+    return results
+
+
+def fit_report(names,pcov,cond_limit=1e8,corr_limit=0.99):
+    '''
+    standard errors and correlations from the covariance matrix of a fit (scipy curve_fit pcov,
+    i.e. from the jacobian at the solution, no additional fits)
+    returns {'stderr' : {name : error},'corr' : correlation matrix,'names','cond' : condition number of corr,
+             'warning' : None or a text if the parameters are not well determined by the data}
+    '''
+    pcov = np.atleast_2d(pcov)
+    err = np.sqrt(np.abs(np.diag(pcov)))
+    rep = {'names':list(names),'stderr':dict(zip(names,err)),'corr':None,'cond':np.inf,'warning':None}
+    if not np.all(np.isfinite(pcov)) or np.any(err == 0) :
+        rep['warning'] = 'the covariance could not be estimated, some parameters are not determined by the data'
+        return rep
+    corr = pcov / np.outer(err,err)
+    rep['corr'] = corr
+    rep['cond'] = np.linalg.cond(corr)
+    pairs = [f'{names[i]}/{names[k]} ({corr[i,k]:1.3f})' for i in range(len(names)) for k in range(i) if abs(corr[i,k]) > corr_limit]
+    if rep['cond'] > cond_limit or pairs :
+        rep['warning'] = f"ill conditioned fit (condition number {rep['cond']:1.2g}), strongly correlated: {', '.join(pairs)}"
+    return rep
  
 
+def fit_global(fits,datasets,shared,x_scale='jac',**kwargs):
+    '''
+    joint fit of several curves with shared parameters as one sparse least squares problem
+    fits : list of curve_fit objects, one per data set (start values and fixed flags per data set)
+    datasets : list of (xdata,ydata)
+    shared : names of the parameters common to all data sets, they must be unfixed in all fits and
+             start from the value in fits[0]. All other unfixed parameters are fitted per data set.
+    The jacobian is block sparse (shared columns + one block per data set), it is assembled from the
+    jacobians of the fits (or estimated by grouped finite differences with the sparsity pattern), so
+    the cost grows linearly with the number of data sets.
+    kwargs : passed to scipy.optimize.least_squares
+    returns {'chi2' : list per data set,'nfev','params' : [{name : value} per data set]}
+    The fitted values are set in the fits, their report() holds the errors and correlations of the free
+    parameters of the data set (see fit_report) from the covariance of the joint fit.
+    '''
+    shared = list(shared)
+    blocks = []
+    p0 = [fits[0]._plist[fits[0]._findme(name)]['val'] for name in shared]
+    row = 0
+    for c,(x,y) in zip(fits,datasets):
+        c._plist[0]['val'] = x
+        c._plist[0]['fixed'] = False
+        c._calc_reduced()
+        free = [p['name'] for p in c.plist if not p['fixed']]
+        for name in shared:
+            assert name in free,f'shared parameter <{name}> is fixed'
+        cols = []
+        for name in free:
+            if name in shared :
+                cols.append(shared.index(name))
+            else :
+                cols.append(len(p0))
+                p0.append(c._plist[c._findme(name)]['val'])
+        func,jac = c._compiled()
+        blocks.append((c,func,jac,free,np.array(cols),x,np.asarray(y),row))
+        row += len(x)
+    nrow,ncol = row,len(p0)
+
+    def residuals(p):
+        return( np.concatenate([func(x,*p[cols]) - y for c,func,jac,free,cols,x,y,row in blocks]) )
+
+    def sparse_jac(p):
+        r,cl,d = [],[],[]
+        for c,func,jac,free,cols,x,y,row in blocks:
+            J = np.asarray(jac(x,*p[cols])).reshape(len(x),len(cols))
+            r.append(np.repeat(np.arange(row,row+len(x)),len(cols)))
+            cl.append(np.tile(cols,len(x)))
+            d.append(J.ravel())
+        return( sparse.csr_matrix((np.concatenate(d),(np.concatenate(r),np.concatenate(cl))),shape=(nrow,ncol)) )
+
+    if all(b[2] is not None for b in blocks):
+        kwargs.setdefault('jac',sparse_jac)
+    else :
+        pattern = sparse.lil_matrix((nrow,ncol),dtype=int)
+        for c,func,jac,free,cols,x,y,row in blocks:
+            pattern[row:row+len(x),cols] = 1
+        kwargs.setdefault('jac_sparsity',pattern)
+    kwargs.setdefault('tr_solver','lsmr')
+    res = opt.least_squares(residuals,np.array(p0,dtype=float),x_scale=x_scale,**kwargs)
+    if not res.success :
+        raise RuntimeError(f'global fit did fail: {res.message}')
+    J = sparse.csr_matrix(res.jac)
+    JTJ = (J.T @ J).toarray()
+    d = np.sqrt(np.diag(JTJ))
+    d[d == 0] = 1
+    # columns normalized for the inversion, the parameter scales differ by many orders of magnitude
+    pcov = np.linalg.pinv(JTJ/np.outer(d,d))/np.outer(d,d) * (2*res.cost/max(nrow - ncol,1)) # as scipy curve_fit (absolute_sigma=False)
+    out = {'chi2':[],'nfev':res.nfev,'params':[]}
+    for c,func,jac,free,cols,x,y,row in blocks:
+        vals = dict(zip(free,res.x[cols]))
+        for name,val in vals.items():
+            c.set(name,val)
+        c._report = fit_report(free,pcov[np.ix_(cols,cols)])
+        out['params'].append(vals)
+        out['chi2'].append(((func(x,*res.x[cols]) - y)**2).sum())
+    return out
+
+
 if __name__ == "__main__":
 
     import numpy as np
@@ -0,0 +1,112 @@
+'''
+preprocessing of measured resonance curves before fitting
+
+wide VNA sweeps have most of their points on the flat baseline far away from the
+resonance dip. The functions here locate the dip, crop the data to a few linewidths
+and thin out the baseline, so that the fit time depends on the resonance shape and
+not on the length of the sweep.
+'''
+import numpy as np
+
+
+def find_resonance(x,y,smooth=5):
+    '''
+    locates the resonance dip in measured data
+    x,y : frequency and reflectivity arrays (x sorted)
+    smooth : width of the moving average used to suppress noise (points)
+    returns (index of the minimum, f0, fwhm), fwhm is the full width at half depth
+    relative to the median baseline
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if smooth > 1 and len(y) > smooth :
+        ys = np.convolve(y,np.ones(smooth)/smooth,mode='same')
+        ys[:smooth//2] = ys[smooth//2] # no zero padding effects at the ends
+        ys[-(smooth//2):] = ys[-(smooth//2)-1]
+    else :
+        ys = y
+    k = int(ys.argmin())
+    half = (np.median(ys) + ys[k])/2
+    above = ys > half
+    left = np.nonzero(above[:k])[0]
+    right = np.nonzero(above[k:])[0]
+    fl = fr = None
+    if len(left) : # linear interpolation of the half depth crossings
+        i = left[-1]
+        fl = x[i] + (x[i+1]-x[i])*(ys[i]-half)/(ys[i]-ys[i+1])
+    if len(right) :
+        i = k + right[0]
+        fr = x[i-1] + (x[i]-x[i-1])*(ys[i-1]-half)/(ys[i-1]-ys[i])
+    if fl is None and fr is None :
+        fwhm = x[-1] - x[0]
+    elif fl is None :
+        fwhm = 2*(fr - x[k])
+    elif fr is None :
+        fwhm = 2*(x[k] - fl)
+    else :
+        fwhm = fr - fl
+    return k , x[k] , fwhm
+
+
+def fit_window(x,y,n_widths=5,baseline_points=200,smooth=5):
+    '''
+    selects the points used for fitting
+    n_widths : the data is cropped to f0 +/- n_widths*fwhm
+    baseline_points : outside of f0 +/- fwhm the cropped data is thinned out to about this number of points,
+                      the dip itself is kept at full resolution. None keeps all points.
+    returns the index array of the selected points
+    '''
+    x = np.asarray(x)
+    k,f0,fwhm = find_resonance(x,y,smooth)
+    d = np.abs(x - f0)
+    idx = np.nonzero(d <= n_widths*fwhm)[0]
+    if baseline_points is not None :
+        base = idx[d[idx] > fwhm]
+        if len(base) > baseline_points :
+            keep = np.zeros(len(x),dtype=bool)
+            keep[idx[d[idx] <= fwhm]] = True
+            keep[base[::int(np.ceil(len(base)/baseline_points))]] = True
+            idx = np.nonzero(keep)[0]
+    return idx
+
+
+def decimate(x,y,max_points=4000,xlim=None):
+    '''
+    reduces a curve for display (min/max decimation), the fit always uses all points
+    the points (within xlim=(x0,x1) if given) are split into max_points/2 buckets of consecutive points
+    and only the minimum and the maximum of each bucket are kept. The envelope and the noise band stay
+    visible and the resonance dip (the global minimum) is kept exactly.
+    returns the index array of the selected points (in their original order)
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y,dtype=float)
+    if xlim is None :
+        idx = np.arange(len(x))
+    else :
+        idx = np.nonzero((x >= xlim[0]) & (x <= xlim[1]))[0]
+    n = len(idx)
+    if n <= max_points :
+        return idx
+    m = int(np.ceil(n/(max_points//2))) # points per bucket
+    nb = int(np.ceil(n/m))
+    yb = np.full(nb*m,np.nan)
+    yb[:n] = y[idx]
+    yb = yb.reshape(nb,m)
+    yb[np.isnan(yb).all(axis=1)] = 0 # buckets without valid data
+    offs = np.arange(nb)*m
+    keep = np.concatenate(([0,n-1],offs + np.nanargmin(yb,axis=1),offs + np.nanargmax(yb,axis=1)))
+    return idx[np.unique(keep)]
+
+
+if __name__ == "__main__":
+
+    rng = np.random.default_rng(0)
+    x = np.linspace(8,10,40000)
+    y = 1 - 0.6/(1+((x-8.7)/0.002)**2) + rng.normal(0,0.005,len(x))
+    print(find_resonance(x,y))
+    idx = fit_window(x,y)
+    print(f'{len(idx)} of {len(x)} points, {x[idx[0]]:1.4f}-{x[idx[-1]]:1.4f} GHz')
+    x = np.linspace(8,10,500000)
+    y = 1 - 0.6/(1+((x-8.7)/0.002)**2) + rng.normal(0,0.005,len(x))
+    idx = decimate(x,y)
+    print(f'decimated {len(x)} -> {len(idx)} points, minimum kept: {y.argmin() in idx}')
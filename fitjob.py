@@ -0,0 +1,119 @@
+'''
+background fits for the streamlit app
+
+a FitJob fits a copy of a curve_fit object in a thread, so that the app stays responsive
+while the fit is running. Every evaluation of the fit function updates the progress (number
+of evaluations, chi2, free parameter values and the model curve), the app polls progress()
+on its reruns. cancel() stops the fit at the next evaluation (multi-start: after the
+running starts).
+'''
+import threading
+import numpy as np
+
+
+class FitCancelled(Exception):
+    'raised in the fit callback to stop a cancelled fit'
+
+
+class FitJob():
+    '''
+    c : curve_fit, the fit runs on a copy, the result is in cfit when status is 'ok'
+    xdata,ydata : fit data
+    bounds : {name : (low,high)} for a multi-start fit (curve_fit.fit_multistart), None for a single fit
+    status : 'running','ok','failed' (see error) or 'cancelled'
+    info : free dict for the caller (e.g. calibration store key)
+    '''
+    def __init__(self,c,xdata,ydata,bounds=None,n_starts=16,info=None,**fitargs):
+        self.cfit = c.copy()
+        self.xdata = xdata
+        self.ydata = ydata
+        self.bounds = bounds
+        self.n_starts = n_starts
+        self.info = {} if info is None else info
+        self.fitargs = fitargs
+        self.status = 'running'
+        self.error = None
+        self.alternatives = None
+        self._free = [p['name'] for p in self.cfit.plist if not p['fixed']]
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._progress = {'n':0,'chi2':np.nan,'params':{},'y':None}
+        self._thread = threading.Thread(target=self._run,daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def join(self,timeout=None):
+        self._thread.join(timeout)
+
+    def progress(self):
+        'snapshot of the progress: {n : evaluations (multi-start: finished fits), chi2, params, y : model curve or None}'
+        with self._lock :
+            return dict(self._progress)
+
+    def _evaluated(self,args,y):
+        'fit callback of a single fit'
+        if self._cancel.is_set() :
+            raise FitCancelled()
+        chi2 = ((y - self.ydata)**2).sum()
+        with self._lock :
+            self._progress = {'n':self._progress['n'] + 1,'chi2':chi2,'params':dict(zip(self._free,args)),'y':y}
+
+    def _start_done(self,res):
+        'fit callback of a multi-start fit, the progress shows the best fit so far'
+        if self._cancel.is_set() :
+            raise FitCancelled()
+        with self._lock :
+            best = res if not res['chi2'] >= self._progress['chi2'] else self._progress
+            self._progress = {'n':self._progress['n'] + 1,'chi2':best['chi2'],'params':best['params'],'y':None}
+
+    def _run(self):
+        try:
+            if self.bounds is None :
+                self.cfit.fit(self.xdata,self.ydata,callback=self._evaluated,**self.fitargs)
+            else :
+                alt = self.cfit.fit_multistart(self.xdata,self.ydata,self.bounds,n_starts=self.n_starts,
+                                               callback=self._start_done,**self.fitargs)
+                self.alternatives = alt[:5]
+                if alt[0]['status'] != 'ok':
+                    raise RuntimeError(alt[0]['status'])
+            self.status = 'ok'
+        except FitCancelled:
+            self.status = 'cancelled'
+        except (RuntimeError,ValueError) as e:
+            self.error = str(e)
+            self.status = 'failed'
+
+
+if __name__ == "__main__":
+
+    import time
+    import s11fit
+
+    c = s11fit.new_fit()
+    x = np.linspace(8.2,9.2,20001)
+    ref = c.copy()
+    ref.set('d_iris',9.7)
+    ref.set('sub_epsr',3.6)
+    y = ref.calc(x)
+
+    job = FitJob(c,x,y).start()
+    while job.running :
+        p = job.progress()
+        print(f"{p['n']:4} evaluations, chi2 = {p['chi2']:1.3g}, {p['params']}")
+        time.sleep(0.05)
+    print(job.status,job.cfit.d_iris,job.cfit.sub_epsr)
+
+    job = FitJob(c,x,y,bounds={'d_iris':(9,10)},n_starts=32,workers=1).start()
+    time.sleep(0.2)
+    job.cancel()
+    job.join()
+    print(job.status,job.progress()['n'])
@@ -17,7 +17,7 @@ class fixparameter():
     '''
     def __init__(self,func=None):
         self._plist = []
-        self._pred = 0              
+        self._calc_reduced()
         if func :
             self.add_by_func(func)
 
@@ -90,23 +90,18 @@ class fixparameter():
         self._calc_reduced()
         
     def func(self,*args):
+        return( self._func(*self._fullargs(args)) )# call the function and return the value
+
+    def _fullargs(self,args):
+        'maps the arguments of the reduced function to the full parameter list'
         assert len(args) == self._pred, f"mismatched number of arguments! Expecting {self._pred}, received {len(args)}"        
-        pnew = [] # the updated parameter list       
-        k = 0
-        for p in self._plist:
-            if p['fixed'] : # use the default parameter
-               pnew.append(p['val']) 
-            else:# use the supplied value and put it into pnew in the right position
-                pnew.append(args[k])
-                k += 1
-        #print(pnew)
-        return( self._func(*pnew) )# call the function and return the value
+        pnew = [p['val'] for p in self._plist] # the fixed values
+        for i,v in zip(self._free,args): # the supplied values at the positions of the unfixed parameters
+            pnew[i] = v
+        return( pnew )
 
     def _findme(self,name):
-        for i,p in enumerate(self._plist):
-            if p['name'] == name :
-                return(i)
-        return( -1 )
+        return( self._index.get(name,-1) )
         
 
     @property
@@ -128,11 +123,10 @@ class fixparameter():
         return x
         
     def _calc_reduced(self):
-        k=0        
-        for i,p in enumerate(self._plist):
-            if p['fixed'] == False:
-                k += 1           
-        self._pred = k
+        'updates the index maps, must be called after the names or fixed flags in the plist were changed'
+        self._free = [i for i,p in enumerate(self._plist) if not p['fixed']] # positions of the unfixed parameters
+        self._index = {p['name']:i for i,p in enumerate(self._plist)}
+        self._pred = len(self._free)
 
     def list_map_reduced(self,mylist):        
         return [mylist[k] for k,p in enumerate(self._plist) if p['fixed'] == False]
@@ -0,0 +1,78 @@
+'''
+the cavity model as fit function for curve_fit, shared by the streamlit app and the batch fitting
+
+the fit functions evaluate the functional core of trmc_network (reflectivity, reflectivity_jac)
+with the waveguide dimensions of a model instance, the instance itself is never modified. Each
+curve_fit has its own S11Fit, so fits of several sessions or threads do not share any state.
+'''
+import numpy as np
+from trmc_network import S11ghz,S11Params,FreqCache,JAC_PARAMS,reflectivity,reflectivity_jac
+from curvefit_ks import curve_fit
+
+_ABS_PARAMS = ('copper_S','layer_sig','sub_sig') # the model uses abs() of these
+_ABS_INDEX = [JAC_PARAMS.index(k) for k in _ABS_PARAMS]
+
+
+class S11Fit():
+    '''
+    fit functions of the cavity model for curve_fit, the parameters are the ones of JAC_PARAMS
+    model : S11ghz (or S11ghz_Ka) that defines the waveguide dimensions a,b
+    The instance is picklable (process pools of fit_multistart and batchfit).
+    '''
+    def __init__(self,model=None):
+        self.model = S11ghz() if model is None else model
+        self.cache = FreqCache() # frequency terms of the fit data, one cache per fit function
+
+    def record(self,values):
+        'S11Params record for the parameter values (order of JAC_PARAMS)'
+        p = list(values)
+        for k in _ABS_INDEX:
+            p[k] = abs(p[k])
+        return( S11Params(self.model.a,self.model.b,*p) )
+
+    def __call__(self,freq_ghz,d1,d2,d_iris,loss_fac,copper_S,layer_t,layer_epsr,layer_sig,sub_t,sub_epsr,sub_sig):
+        p = self.record((d1,d2,d_iris,loss_fac,copper_S,layer_t,layer_epsr,layer_sig,sub_t,sub_epsr,sub_sig))
+        return( reflectivity(freq_ghz,p,self.cache) )
+
+    def jac(self,freq_ghz,d1,d2,d_iris,loss_fac,copper_S,layer_t,layer_epsr,layer_sig,sub_t,sub_epsr,sub_sig,free=JAC_PARAMS):
+        'analytic jacobian, one column for each parameter name in free'
+        return( self.vjac(freq_ghz,(d1,d2,d_iris,loss_fac,copper_S,layer_t,layer_epsr,layer_sig,sub_t,sub_epsr,sub_sig),free) )
+
+    def vfunc(self,freq_ghz,pvec):
+        'vector version for the fit loop (see curve_fit), pvec in the order of JAC_PARAMS'
+        return( reflectivity(freq_ghz,self.record(pvec),self.cache) )
+
+    def vjac(self,freq_ghz,pvec,free):
+        J = reflectivity_jac(freq_ghz,self.record(pvec),free,self.cache)[1]
+        for k,name in enumerate(free):
+            if name in _ABS_PARAMS : # the model uses abs()
+                J[:,k] *= np.copysign(1,pvec[JAC_PARAMS.index(name)])
+        return( J )
+
+
+def new_fit(model=None):
+    '''
+    curve_fit of the cavity model with the default start values and fixed flags of the app
+    model : S11ghz instance for the waveguide dimensions, default is a new S11ghz
+    '''
+    f = S11Fit(model)
+    c = curve_fit(f,jac=f.jac,vfunc=f.vfunc,vjac=f.vjac)
+    c.set('d1',35.825,True)
+    c.set('d2',11,True)
+    c.set('d_iris',9.6,False)
+    c.set('loss_fac',1e-7,False)
+    c.set('copper_S',5.5e7,True)
+    c.set('layer_t',0.001,True)
+    c.set('layer_epsr',1,True)
+    c.set('layer_sig',0,True)
+    c.set('sub_t',1,True)
+    c.set('sub_epsr',1,False)
+    c.set('sub_sig',0,True)
+    return c
+
+
+def set_model(model,c):
+    'sets the parameters of the model instance to the current values of the curve_fit c (e.g. for the k-factor)'
+    for name in JAC_PARAMS:
+        val = getattr(c,name)
+        setattr(model,name,abs(val) if name in _ABS_PARAMS else val)
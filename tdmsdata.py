@@ -0,0 +1,134 @@
+'''
+reads resonance curves from TDMS files (National Instruments, e.g. VNA recordings)
+
+the files are opened in streaming mode: only the metadata is read on opening and
+only the selected part of the selected channels is loaded, so the memory use does
+not depend on the number of sweeps or channels in the file
+'''
+import numpy as np
+from nptdms import TdmsFile
+
+
+def list_channels(file):
+    '''
+    file : path or binary file object
+    returns {group name : [channel names]} without reading any channel data
+    '''
+    if hasattr(file,'seek'): # file objects are read from the start
+        file.seek(0)
+    with TdmsFile.open(file) as tf:
+        return {g.name:[c.name for c in g.channels()] for g in tf.groups()}
+
+
+def _sweep_len(group,freq_channel,s11_channel,block=65536):
+    '''
+    internal helper: number of points per sweep of the S11 channel (opened TdmsFile group)
+    - a frequency channel shorter than the S11 channel holds the frequencies of one sweep
+    - a frequency channel with all sweeps restarts at the start frequency with every sweep,
+      it is read block by block up to the first restart
+    - without frequency channel the waveform property wf_samples of the S11 channel is used
+    a channel with a single sweep returns its length
+    '''
+    sc = group[s11_channel]
+    if freq_channel is None :
+        return int(sc.properties.get('wf_samples',len(sc))) or len(sc)
+    fc = group[freq_channel]
+    if len(fc) < len(sc) :
+        return len(fc)
+    direction = None
+    offset = 0 # index of f[0] in the channel
+    f = np.empty(0)
+    for start in range(0,len(fc),block):
+        f = np.concatenate((f[-1:],fc[start:start+block])) # the last point of the previous block for the step
+        offset = start - 1 if start else 0
+        d = np.sign(np.diff(f)) # d[i] : step from point offset+i to offset+i+1
+        if direction is None and len(d) :
+            direction = d[0]
+        turn = np.nonzero(d == -direction)[0] if direction else []
+        if len(turn) :
+            return int(offset + turn[0] + 1) # first point of the second sweep
+    return len(sc)
+
+
+def sweep_info(file,group,freq_channel,s11_channel,sweep_len=None):
+    '''
+    returns (points per sweep,number of sweeps) of the S11 channel, see read_tdms
+    sweep_len : points per sweep, None finds it from the frequency channel (or the waveform properties)
+    '''
+    if hasattr(file,'seek'): # file objects are read from the start
+        file.seek(0)
+    with TdmsFile.open(file) as tf:
+        if sweep_len is None :
+            sweep_len = _sweep_len(tf[group],freq_channel,s11_channel)
+        return sweep_len , len(tf[group][s11_channel]) // sweep_len
+
+
+def read_tdms(file,group,freq_channel,s11_channel,sweep=None,sweep_len=None):
+    '''
+    reads a resonance curve as (N x 2) array (frequency,S11) like textdata.read_textarray
+    file : path or binary file object
+    group,s11_channel : names of the group and the S11 channel
+    freq_channel : name of the frequency channel, for None the frequency is taken from the
+                   waveform properties (wf_start_offset,wf_increment) of the S11 channel
+    sweep,sweep_len : for channels holding several consecutive sweeps of sweep_len points
+                      only sweep number <sweep> is read. A frequency channel with the points
+                      of a single sweep is repeated for all sweeps. For sweep_len None the
+                      length is found from the frequency channel (see sweep_info).
+    raises ValueError if the sweep is not in the channel or the frequencies are not defined
+    '''
+    if hasattr(file,'seek'): # file objects are read from the start
+        file.seek(0)
+    with TdmsFile.open(file) as tf:
+        sc = tf[group][s11_channel]
+        if sweep is not None and sweep_len is None :
+            sweep_len = _sweep_len(tf[group],freq_channel,s11_channel)
+        if sweep is None :
+            sl = slice(0,len(sc))
+        else :
+            sl = slice(sweep*sweep_len,(sweep+1)*sweep_len)
+            if sweep < 0 or sl.stop > len(sc) :
+                raise ValueError(f'sweep {sweep} not in channel <{s11_channel}> ({len(sc)//sweep_len} sweeps of {sweep_len} points)')
+        data = np.empty((sl.stop-sl.start,2))
+        data[:,1] = sc[sl]
+        if freq_channel is None :
+            p = sc.properties
+            if 'wf_increment' not in p :
+                raise ValueError(f'channel <{s11_channel}> has no waveform properties, select a frequency channel')
+            data[:,0] = p.get('wf_start_offset',0.0) + np.arange(len(data))*p['wf_increment']
+        else :
+            fc = tf[group][freq_channel]
+            if len(fc) < len(sc) : # the frequencies of a single sweep
+                data[:,0] = fc[:][np.arange(sl.start,sl.stop) % len(fc)]
+            else :
+                data[:,0] = fc[sl]
+    return data
+
+
+if __name__ == "__main__":
+
+    import os
+    import tempfile
+    from nptdms import TdmsWriter, ChannelObject
+
+    n,nsweep = 20000,50
+    f = np.linspace(8e9,9.5e9,n)
+    with tempfile.TemporaryDirectory() as tmp :
+        # demo file with 50 sweeps of 20000 points in one channel, the frequencies are written once
+        fname = os.path.join(tmp,'temp.tdms')
+        with TdmsWriter(fname) as w:
+            w.write_segment([ChannelObject('vna','freq',f)])
+            for k in range(nsweep):
+                w.write_segment([ChannelObject('vna','S11',1-0.5/(1+((f-8.5e9-k*1e5)/2e6)**2))])
+        print(list_channels(fname))
+        print(sweep_info(fname,'vna','freq','S11'))
+        d = read_tdms(fname,'vna','freq','S11',sweep=nsweep-1)
+        print(d.shape,d[d[:,1].argmin()])
+
+        # the frequencies are written again with every sweep
+        fname = os.path.join(tmp,'temp2.tdms')
+        with TdmsWriter(fname) as w:
+            for k in range(nsweep):
+                w.write_segment([ChannelObject('vna','freq',f),ChannelObject('vna','S11',1-0.5/(1+((f-8.5e9-k*1e5)/2e6)**2))])
+        print(sweep_info(fname,'vna','freq','S11'))
+        d = read_tdms(fname,'vna','freq','S11',sweep=nsweep-1)
+        print(d.shape,d[d[:,1].argmin()])
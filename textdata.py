@@ -1,6 +1,7 @@
 import pathlib
 import re
 import io
+import numpy as np
 
 VALID_NUMSTART = '0123456789+-'
 COL_SEPERATOR_RE = '[\s;,]+' #normal whitespaces + , ;    (at least 1)
@@ -44,6 +45,7 @@ def read_textdata(file,german_num=False):
                                 else : # first numeric row
                                         n_col = len(y)
                                         firstline = k
+                                        tabdat += [y]
                                 lines += 1                                        
                         except :                                        
                                 break
@@ -64,6 +66,61 @@ def read_textdata(file,german_num=False):
         return(d)
 
 
+def read_textarray(file,german_num=False):
+        '''
+        fast version of read_textdata for large files:
+        only the header is scanned line by line, the numeric block is parsed in bulk
+        returns the same dict as read_textdata, but 'data' is a (rows x col) numpy array
+        files with an irregular numeric block (e.g. trailing text) are passed to read_textdata
+        '''
+        if isinstance(file,io.TextIOBase):
+                text = file.read()
+        else:
+                with open(pathlib.Path(file),'r') as fp:
+                        text = fp.read()
+
+        reg = re.compile(COL_SEPERATOR_RE)
+        header = []
+        pos = 0
+        k = 0
+        n_col = -1
+        while pos < len(text): # find the first numeric row
+                end = text.find('\n',pos) + 1
+                if end == 0 :
+                        end = len(text)
+                line = text[pos:end]
+                if german_num :
+                        line = line.replace(',','.')
+                x = reg.split(line.strip())
+                if len(x[0]) > 0 :
+                        if x[0][0] not in VALID_NUMSTART :
+                                header.append(line)
+                        else :
+                                try :
+                                        n_col = len([float(y) for y in x])
+                                except ValueError :
+                                        pass
+                                break
+                pos = end
+                k += 1
+
+        if n_col > 0 :
+                block = text[pos:]
+                if german_num :
+                        block = block.replace(',','.').replace(';',' ')
+                else :
+                        block = block.replace(';',' ').replace(',',' ')
+                try :
+                        data = np.loadtxt(io.StringIO(block),dtype=float,comments=None,ndmin=2)
+                        if data.shape[1] == n_col :
+                                return {'data':data,'header':header,'rows':len(data),'col':n_col,'firstline':k}
+                except ValueError : # irregular numeric block
+                        pass
+
+        d = read_textdata(io.StringIO(text),german_num)
+        d['data'] = np.array(d['data'],dtype=float).reshape(len(d['data']),max(d['col'],0))
+        return(d)
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,225 @@
+'''
+conversion of transient TRMC traces (dP/P vs time) to photoconductance and mobility
+
+conventions (k-factor as in S11ghz.kfactor, i.e. dP/P = K dG):
+dG = dP/P / K                      photoconductance in S,  dG = beta * layer_t * dsigma
+phi*sum(mu) = dG / (beta e I0 FA)  in cm2/Vs for I0 in photons/cm2 per pulse, FA the absorbed fraction
+
+the traces are processed in chunks: .npy files (traces x time points) are memory mapped and
+the result is written incrementally into a .npy file of the same shape, text trace files
+are converted file by file. Both are distributed over a process pool.
+'''
+import os
+import pathlib
+import hashlib
+import concurrent.futures
+import numpy as np
+
+import textdata
+
+E_CHARGE = 1.602176634e-19
+TABLE_DIR = pathlib.Path.home() / '.trmcapp' / 'tables' # default location of the SigmaTable files
+
+
+class TraceConversion():
+    '''
+    dP/P -> dG (or phi*sum(mu) if I0 and FA are given)
+    kfac : k-factor (S11ghz.kfactor at the working frequency)
+    beta : waveguide aspect ratio a/b, default is the one of model (or table), else X-band (WR-90)
+    model,freq_in_ghz : optional S11ghz and working frequency for the nonlinear conversion,
+                        dsigma is solved from R(layer_sig + dsigma)/R(layer_sig) - 1 = dP/P
+    table : optional SigmaTable for a fast nonlinear conversion (replaces model)
+    layer : index of the photoconductive layer in model.stack (S11ghz: 0 is the layer, S11stack: any layer)
+    '''
+    def __init__(self,kfac,beta=None,I0=None,FA=None,model=None,freq_in_ghz=None,iterations=8,table=None,layer=0):
+        self.kfac = kfac
+        self.table = table
+        if beta is None :
+            if model is not None :
+                beta = model.a/model.b
+            elif table is not None :
+                beta = table.beta
+            else :
+                beta = 22.86/10.16
+        self.beta = beta
+        self.I0 = I0
+        self.FA = FA
+        self.model = model
+        self.freq = freq_in_ghz
+        self.iterations = iterations
+        self.layer = layer
+
+    def dsigma(self,dpp):
+        'nonlinear conversion: vectorized Newton iteration for the conductivity change in S/m'
+        m = self.model
+        t_name,sig_name,layer_t,layer_sig = m._layer(self.layer)
+        t_in_m = layer_t*1e-3
+        # always double precision: dP/P is a small difference of reflectivities
+        r0 = m.sweep(self.freq,precision='double')[0,0]
+        x = dpp.ravel() / (self.kfac*self.beta*t_in_m) # linear start value
+        for k in range(self.iterations):
+            sig = layer_sig + x
+            r = m.sweep(self.freq,precision='double',**{sig_name:sig})[:,0]
+            drds = m.kfactor_map(self.freq,layer_sig=sig,precision='double',layer=self.layer)[0,:,0] * r*t_in_m*m.a/m.b
+            x = x - (r/r0 - 1 - dpp.ravel()) / (drds/r0)
+        return( x.reshape(dpp.shape) )
+
+    def __call__(self,dpp):
+        dpp = np.asarray(dpp,dtype=float)
+        if self.table is not None :
+            dg = self.table(dpp)
+        elif self.model is None :
+            dg = dpp / self.kfac
+        else :
+            dg = self.dsigma(dpp) * self.beta*self.model._layer(self.layer)[2]*1e-3
+        if self.I0 is not None and self.FA is not None :
+            return( dg / (self.beta*E_CHARGE*self.I0*self.FA) )
+        return( dg )
+
+
+class SigmaTable():
+    '''
+    precomputed nonlinear inversion dP/P -> dsigma at the working frequency
+    R(sigma + dsigma)/R(sigma) - 1 (sigma of the photoconductive layer) is calculated once on a dense dsigma grid for the current
+    parameters of model, the inversion is a vectorized linear interpolation. The grid ends at the first
+    extremum, so that it is monotonic (dsig_range holds the usable range). error is the largest
+    interpolation error in S/m, estimated at the interval midpoints.
+    The table is saved in cache_dir with a key derived from the parameters and reused when it exists.
+    layer : index of the photoconductive layer in model.stack
+    '''
+    def __init__(self,model,freq_in_ghz,dsig_max,n=4001,cache_dir=TABLE_DIR,layer=0):
+        self.freq = float(freq_in_ghz)
+        t_name,sig_name,self.layer_t,layer_sig = model._layer(layer)
+        self.beta = model.a/model.b
+        params = {k:v for k,v in vars(model).items() if k[0] != '_' and k != 'precision'}
+        key = hashlib.sha1(repr((sorted(params.items()),self.freq,dsig_max,n,layer)).encode()).hexdigest()[:16]
+        fname = None
+        if cache_dir is not None :
+            fname = pathlib.Path(cache_dir) / f'sigtab_{key}.npz'
+            if fname.exists() :
+                d = np.load(fname)
+                self.dsig,self.dpp,self.error = d['dsig'],d['dpp'],float(d['error'])
+                self.dsig_range = (self.dsig[0],self.dsig[-1])
+                return
+        dsig = np.linspace(0,dsig_max,n)
+        # always double precision: dpp is a small difference of reflectivities
+        r0 = model.sweep(self.freq,precision='double')[0,0]
+        dpp = model.sweep(self.freq,precision='double',**{sig_name:layer_sig + dsig})[:,0]/r0 - 1
+        d = np.diff(dpp)
+        turn = np.nonzero(np.sign(d) != np.sign(d[0]))[0] # cut at the first extremum
+        if len(turn) :
+            dsig,dpp = dsig[:turn[0]+1],dpp[:turn[0]+1]
+        mid = (dsig[1:] + dsig[:-1])/2
+        dpp_mid = model.sweep(self.freq,precision='double',**{sig_name:layer_sig + mid})[:,0]/r0 - 1
+        self.dsig,self.dpp = dsig,dpp
+        self.error = float(np.nanmax(np.abs(self.dsigma(dpp_mid) - mid)))
+        self.dsig_range = (dsig[0],dsig[-1])
+        if fname is not None :
+            fname.parent.mkdir(parents=True,exist_ok=True)
+            np.savez(fname,dsig=self.dsig,dpp=self.dpp,error=self.error)
+
+    def dsigma(self,dpp):
+        'dsigma in S/m for dP/P, nan outside of the table range'
+        if self.dpp[-1] > self.dpp[0] :
+            return( np.interp(dpp,self.dpp,self.dsig,left=np.nan,right=np.nan) )
+        return( np.interp(dpp,self.dpp[::-1],self.dsig[::-1],left=np.nan,right=np.nan) )
+
+    def __call__(self,dpp):
+        'photoconductance dG in S for dP/P'
+        return( self.dsigma(dpp)*self.beta*self.layer_t*1e-3 )
+
+
+def _convert_rows(job):
+    'internal helper: converts the rows start:stop of a memory mapped .npy file'
+    src,dst,conv,start,stop = job
+    x = np.load(src,mmap_mode='r')
+    y = np.load(dst,mmap_mode='r+')
+    y[start:stop] = conv(x[start:stop])
+    y.flush()
+    return stop - start
+
+
+def convert_npy(src,dst,conv,chunk_rows=1024,processes=None):
+    '''
+    converts all traces of the .npy file src (traces x time points) with conv (TraceConversion)
+    the result is written chunk by chunk to the .npy file dst, so the data can be larger than the memory
+    processes : number of worker processes, default is the number of cpu cores
+    returns the number of converted traces
+    '''
+    x = np.load(src,mmap_mode='r')
+    y = np.lib.format.open_memmap(dst,mode='w+',dtype=float,shape=x.shape)
+    del y
+    n = x.shape[0]
+    jobs = [(src,dst,conv,k,min(k+chunk_rows,n)) for k in range(0,n,chunk_rows)]
+    return( _run(jobs,_convert_rows,processes) )
+
+
+def _convert_file(job):
+    'internal helper: converts a text trace file (time, dP/P columns ...)'
+    src,dst,conv = job
+    d = textdata.read_textarray(src)['data']
+    d[:,1:] = conv(d[:,1:])
+    np.savetxt(dst,d,header=f'converted from {src}')
+    return 1
+
+
+def convert_files(files,outdir,conv,processes=None):
+    '''
+    converts text trace files with a time column followed by one or more dP/P columns
+    the results are written with the same names to outdir
+    '''
+    outdir = pathlib.Path(outdir)
+    outdir.mkdir(parents=True,exist_ok=True)
+    jobs = [(str(f),str(outdir / pathlib.Path(f).name),conv) for f in files]
+    return( _run(jobs,_convert_file,processes) )
+
+
+def _run(jobs,func,processes):
+    'internal helper: runs the jobs in a process pool'
+    if processes is None :
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(jobs) < 2 :
+        return sum(func(j) for j in jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as ex :
+        return sum(ex.map(func,jobs))
+
+
+if __name__ == "__main__":
+
+    import time
+    import tempfile
+    from trmc_network import S11ghz
+
+    s = S11ghz()
+    s.layer_sig = 0.1
+    f0 = s.resonance(8.1,9.2)['f0']
+    kfac = s.kfactor(f0)
+
+    with tempfile.TemporaryDirectory() as tmp :
+        src = os.path.join(tmp,'traces.npy')
+        dst = os.path.join(tmp,'dg.npy')
+
+        # 20000 traces with 2000 time points (320 MB)
+        t = np.linspace(0,1e-6,2000)
+        x = np.lib.format.open_memmap(src,mode='w+',dtype=float,shape=(20000,len(t)))
+        for k in range(0,len(x),1000):
+            x[k:k+1000] = -1e-3*np.exp(-t/(1e-7*(1+np.arange(1000)[:,None]/1000)))
+        x.flush()
+        del x
+
+        t0 = time.perf_counter()
+        n = convert_npy(src,dst,TraceConversion(kfac,I0=1e13,FA=0.5))
+        print(f'{n} traces in {time.perf_counter()-t0:1.2f}s')
+        y = np.load(dst,mmap_mode='r')
+        print(y[0,:3])
+        del y
+
+        conv = TraceConversion(kfac,model=s,freq_in_ghz=f0)
+        print(conv(np.array([-1e-3,-1e-2,-0.1])) , np.array([-1e-3,-1e-2,-0.1])/kfac)
+
+        table = SigmaTable(s,f0,dsig_max=50,cache_dir=tmp)
+        print(f'table range {table.dsig_range} S/m, error {table.error:1.2g} S/m')
+        dpp = -np.random.random(1000000)*0.1
+        t0 = time.perf_counter()
+        dg = TraceConversion(kfac,table=table)(dpp)
+        print(f'{len(dpp)} samples in {time.perf_counter()-t0:1.3f}s')
@@ -1,6 +1,8 @@
 import math
 import cmath
+import collections
 import numpy as np
+import scipy.optimize as opt
 
 '''
 original IGOR script function from Tom Savenije group transcribed to a Python class
@@ -32,6 +34,253 @@ Marcuvitz, N.; Laboratory, M. I. of T. R. Waveguide Handbook; IET, 1951.
 
 '''
 
+_SWEEP_BLOCK = 16384 # number of grid points evaluated at once by S11ghz.sweep
+SINGLE_TOL = 1e-4 # single precision mode: max. abs. error of the reflectivity, else double precision is used
+SINGLE_KTOL = 1e-2 # single precision mode: max. relative error of kfactor_map
+_CHECK_POINTS = 32 # single precision mode: the double precision check uses +/- _CHECK_POINTS grid points around the minimum
+CAVITY_PARAMS = ('d1','d2','d_iris','loss_fac','copper_S')
+# the (thickness,epsr,sigma) parameter names of the S11ghz layers, from the cavity end (d1) to the iris side (d2)
+S11_STACK = (('layer_t','layer_epsr','layer_sig'),('sub_t','sub_epsr','sub_sig'))
+# parameters of S11ghz for S11ghz.jacobian and S11ghz.sweep, this is also the parameter order of the fit function in app.py
+JAC_PARAMS = CAVITY_PARAMS + S11_STACK[0] + S11_STACK[1]
+# parameter record of the functional core (s11_complex, reflectivity): waveguide a,b in mm and JAC_PARAMS
+S11Params = collections.namedtuple('S11Params',('a','b') + JAC_PARAMS)
+
+
+def _prop(adm,gd):
+    'internal helper function, numpy version'
+    t = np.tanh(gd)
+    return( (t + adm) / (1 + adm*t) )
+
+
+def _dlin(*terms):
+    'internal helper: linear combination of derivative dicts, terms are (factor,dict) pairs'
+    out = {}
+    for fac,d in terms:
+        for k,v in d.items():
+            out[k] = out.get(k,0) + fac*v
+    return( out )
+
+
+def _prop_jac(yrel,dy,g0,dg0,g1,dg1,t,t_name,wrt):
+    '''
+    internal helper: transfers the admittance yrel from a section with propagation constant g0
+    into the next one (g1) and propagates it over the thickness t in mm,
+    dy,dg0,dg1 are the derivative dicts of yrel,g0,g1
+    '''
+    r = g0/g1
+    dr = _dlin((1/g1,dg0),(-r/g1,dg1))
+    dy = _dlin((r,dy),(yrel,dr))
+    yrel = yrel * g0/g1 # no inplace ops: the parameter arrays may broadcast yrel to a larger shape
+    x = g1*t/1000
+    dx = _dlin((t/1000,dg1))
+    if t_name in wrt :
+        dx[t_name] = dx.get(t_name,0) + g1/1000
+    th = np.tanh(x)
+    den = 1 + yrel*th
+    dpdy = (1 - th*th)/den**2 
+    dy = _dlin((dpdy,dy),((1 - yrel*yrel)*dpdy,dx))
+    return( (th + yrel)/den , dy )
+
+
+def _freq_terms(freq_in_ghz,a_mm,d_iris,loss_fac,copper_S,d1):
+    '''
+    internal helper: the terms of the model that depend only on the frequency,
+    the waveguide width, the iris, the copper loss and the cavity end part
+    returns (om/c)^2 , om*mu0 , (pi/a)^2 , b_iris , loss_unit , loss , gair , yend
+    '''
+    pi = math.pi
+    mu0 = pi*4e-7
+    a = a_mm / 1000.0 # long side of waveguide in m        
+    eps0 = 8.842e-12
+    sc = copper_S # copper conductivity        
+    c = 1/math.sqrt(eps0*mu0)
+    om = 2e9*pi*np.asarray(freq_in_ghz) # angular frequency
+
+    # iris impedance
+    tmp = np.sqrt((om/c)**2 - (pi/a)**2) + 0j
+    b_iris = 1.5*a*a/(d_iris/1000)**3 / tmp
+
+    tmp = (pi*c/a/om)**2 +0j
+    loss_unit = np.sqrt(2*eps0*om*sc)/a * (1+tmp)/np.sqrt(1-tmp)
+    loss = loss_fac * loss_unit
+
+    # cavity end part
+    gsq  = (pi/a)**2 - (om/c)**2 + 0j
+    gair = np.sqrt(gsq) +  loss + 0j
+    yend = 1/np.tanh(gair*d1/1000)
+    return( (om/c)**2 , om*mu0 , (pi/a)**2 , b_iris , loss_unit , loss , gair , yend )
+
+
+class FreqCache():
+    '''
+    single entry cache for the frequency only terms of the model (see _freq_terms)
+    The entry is keyed by the frequency values and the values of a, d_iris, loss_fac, copper_S
+    and d1, it is recalculated whenever one of them changes. The entry keeps a copy of the
+    frequency array, so changes of the array in place are detected (an O(n) comparison,
+    cheap compared to the transcendental functions it saves).
+    The entry is read and replaced as a whole, so a cache can be shared between threads
+    (hits and misses are not exact then).
+    '''
+    def __init__(self):
+        self._entry = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,freq_in_ghz,a_mm,d_iris,loss_fac,copper_S,d1):
+        key = (a_mm,d_iris,loss_fac,copper_S,d1)
+        if any(np.ndim(v) for v in key): # parameter sweeps are not cached
+            return( _freq_terms(freq_in_ghz,*key) )
+        entry = self._entry # a single read, the entry is replaced as a whole
+        if entry is not None and entry[1] == key and np.array_equal(entry[0],freq_in_ghz) :
+            self.hits += 1
+            return( entry[2] )
+        self.misses += 1
+        terms = _freq_terms(freq_in_ghz,*key)
+        self._entry = (np.array(freq_in_ghz,copy=True),key,terms)
+        return( terms )
+
+    def clear(self):
+        self._entry = None
+
+
+def _s11_jac(freq_in_ghz,p,wrt=(),cache=None,stack=S11_STACK): 
+    '''
+    calculates the complex S11 parameter and its derivatives, numpy version
+    freq_in_ghz : numpy array or scalar
+    p : mapping with the model parameters (names as in S11ghz), the values can be
+        scalars or numpy arrays that broadcast against freq_in_ghz
+    wrt : names of the parameters (see JAC_PARAMS) to differentiate for, the chain rule
+          is applied alongside the model calculation (forward mode)
+    cache : optional FreqCache for the frequency only terms
+    stack : the (thickness,epsr,sigma) names in p for each layer, ordered from the cavity end to the iris side
+    returns s11 , {name : d s11/d name}
+    '''
+    # d2 = p['d2'] - p['sub_t'] # the original formula assumes a stack, so that increasing the substrate thickness increases the total cavity length
+    d2 = p['d2']
+    fargs = (freq_in_ghz,p['a'],p['d_iris'],p['loss_fac'],p['copper_S'],p['d1'])
+    if cache is None :
+        k2,omu,kc2,b_iris,loss_unit,loss,gair,yrel = _freq_terms(*fargs)
+    else :
+        k2,omu,kc2,b_iris,loss_unit,loss,gair,yrel = cache.get(*fargs)
+    dloss = {}
+    if 'loss_fac' in wrt :
+        dloss['loss_fac'] = loss_unit
+    if 'copper_S' in wrt :
+        dloss['copper_S'] = loss/(2*p['copper_S'])
+
+    # cavity end part
+    dx = _dlin((p['d1']/1000,dloss))
+    if 'd1' in wrt :
+        dx['d1'] = dx.get('d1',0) + gair/1000
+    dy = _dlin((1 - yrel*yrel,dx)) # yrel = 1/tanh(gair*d1/1000) from _freq_terms
+
+    # layer impedances (layer and substrate for S11ghz)
+    g,dg = gair,dloss
+    for t_name,eps_name,sig_name in stack:
+        gsq = kc2-p[eps_name]*k2 + (p[sig_name]*omu) * 1j
+        root = np.sqrt(gsq)
+        gl = root + loss
+        dgl = dict(dloss)
+        if eps_name in wrt :
+            dgl[eps_name] = -k2/(2*root)
+        if sig_name in wrt :
+            dgl[sig_name] = 1j*omu/(2*root)
+        yrel,dy = _prop_jac(yrel,dy,g,dg,gl,dgl,p[t_name],t_name,wrt)
+        g,dg = gl,dgl
+
+    # iris cavity part
+    yrel,dy = _prop_jac(yrel,dy,g,dg,gair,dloss,d2,'d2',wrt)
+    yrel = yrel - b_iris*1j
+    if 'd_iris' in wrt :
+        dy['d_iris'] = dy.get('d_iris',0) + 3j*b_iris/p['d_iris']
+    ret = (1-yrel)/(1+yrel)
+    dret = {k : -2*dy.get(k,0)/(1+yrel)**2 for k in wrt}
+    return( ret , dret )
+
+
+def _s11(freq_in_ghz,p,cache=None,stack=S11_STACK): 
+    '''
+    calculates the complex S11 parameter, numpy version
+    freq_in_ghz : numpy array or scalar
+    p : mapping with the model parameters (names as in S11ghz), the values can be
+        scalars or numpy arrays that broadcast against freq_in_ghz
+    cache : optional FreqCache for the frequency only terms
+    stack : the (thickness,epsr,sigma) names in p for each layer, see _s11_jac
+    '''
+    return( _s11_jac(freq_in_ghz,p,cache=cache,stack=stack)[0] )
+
+
+class _SingleTerms():
+    '''
+    internal helper of the single precision mode: cache interface (see FreqCache) that calculates the frequency
+    only terms in double precision (the phases need the full resolution of the frequency) and returns them
+    as float32/complex64, so that the model functions run in complex64
+    '''
+    def get(self,freq_in_ghz,*args):
+        terms = _freq_terms(freq_in_ghz,*(np.asarray(v,dtype=float) for v in args))
+        return( tuple(np.asarray(x).astype(np.complex64 if np.iscomplexobj(x) else np.float32) for x in terms) )
+
+
+def _single(p,stack=S11_STACK):
+    'internal helper: the model parameters as float32 for the single precision mode (use with cache=_SingleTerms())'
+    p = dict(p)
+    for k in ('a','d1','d2','d_iris','loss_fac','copper_S') + sum(stack,()):
+        p[k] = np.asarray(p[k],dtype=np.float32) if np.ndim(p[k]) else np.float32(p[k])
+    return( p )
+
+
+def _double_check(freq_in_ghz,p,r,wrt=(),stack=S11_STACK):
+    '''
+    internal helper of the single precision mode: recalculates S11 (and the derivatives wrt) in double
+    precision for the parameter set with the deepest resonance in the single precision reflectivity r,
+    on the grid points around its minimum, where the cancellation in (1-yrel)/(1+yrel) is worst
+    freq_in_ghz,p : double precision frequency and parameters, scalars or arrays with the dimensions of r
+    returns the index of the checked points in r , s , {name : ds/dname}
+    '''
+    if np.ndim(r) == 0 :
+        return( () , *_s11_jac(freq_in_ghz,p,wrt,stack=stack) )
+    k = np.unravel_index(np.nanargmin(r),np.shape(r)) if np.isfinite(r).any() else (0,)*np.ndim(r)
+    sel = slice(max(k[-1] - _CHECK_POINTS,0),k[-1] + _CHECK_POINTS + 1)
+    def pick(v):
+        if np.ndim(v) == 0 :
+            return( v )
+        return( v[tuple(i if n > 1 else 0 for i,n in zip(k[:-1],v.shape[:-1])) + ((sel if v.shape[-1] > 1 else slice(None)),)] )
+    pk = {key:(pick(v) if isinstance(v,(np.ndarray,np.number,float,int)) else v) for key,v in p.items()}
+    return( k[:-1] + (sel,) , *_s11_jac(pick(freq_in_ghz),pk,wrt,stack=stack) )
+
+
+def s11_complex(freq_in_ghz,params,cache=None,stack=S11_STACK):
+    '''
+    functional core of the model: the complex S11 for the parameter record params
+    params : S11Params or a mapping with the same names (S11stack: see S11stack.params)
+    cache : optional FreqCache
+    Nothing is modified, so calls can run concurrently (e.g. fits in a thread pool).
+    '''
+    if isinstance(params,tuple):
+        params = params._asdict()
+    return( _s11(freq_in_ghz,params,cache,stack) )
+
+
+def reflectivity(freq_in_ghz,params,cache=None,stack=S11_STACK):
+    'the normalized reflected RF power for the parameter record params, see s11_complex'
+    s = s11_complex(freq_in_ghz,params,cache,stack)
+    return( (s * s.conjugate()).real )
+
+
+def reflectivity_jac(freq_in_ghz,params,wrt,cache=None,stack=S11_STACK):
+    '''
+    the reflectivity and its exact derivatives for the parameter record params, see s11_complex
+    wrt : parameter names (see JAC_PARAMS)
+    returns r , array of shape (len(freq_in_ghz) x len(wrt)), one column per parameter
+    '''
+    if isinstance(params,tuple):
+        params = params._asdict()
+    s,ds = _s11_jac(freq_in_ghz,params,wrt,cache,stack)
+    sc = s.conjugate()
+    return( (s * sc).real , np.stack([np.broadcast_to(2*(sc*ds[k]).real,s.shape) for k in wrt],axis=-1) )
+
+
 class S11ghz():
 
     def __init__(self):
@@ -51,10 +300,15 @@ class S11ghz():
         self.sub_t = 1          # substrate thickness in mm
         self.sub_epsr = 3.6     # substrate (quartz) epsr
         self.sub_sig = 0        # substrate (quartz) sigma S/m
+        # 'single' : calc, sweep and kfactor_map in complex64 (half the memory), checked against double precision
+        # near the resonance, where an error > SINGLE_TOL switches back to double (jacobian and kfactor are always double)
+        self.precision = 'double'
+        self._single_check = {'checks':0,'double':0,'max_err':0.0} # statistics of the last single precision call
+        self._fcache = FreqCache() # frequency only terms for repeated calls on the same frequency array
               
     def _prop(self,adm,gd):
         'internal helper function, numpy version'
-        return( (np.tanh(gd) + adm) / (1 + adm*np.tanh(gd)) )
+        return( _prop(adm,gd) )
     
     def calc(self,freq_in_ghz): 
         'calculates the normalized reflected RF power'
@@ -64,47 +318,143 @@ class S11ghz():
     def _calc(self,freq_in_ghz): 
         'calculates the complex S11 parameter, numpy version' 
         'freq_in_ghz : numpy array or scalar'       
-
-        # d2 = self.d2 - self.sub_t # the original formula assumes a stack, so that increasing the substrate thickness increases the total cavity length
-        d2 = self.d2
-        pi = math.pi
-        mu0 = pi*4e-7
-        a = self.a / 1000.0 # long side of waveguide in m        
-        eps0 = 8.842e-12
-        sc = self.copper_S # copper conductivity        
-        c = 1/math.sqrt(eps0*mu0)
-        om = 2e9*pi*freq_in_ghz # angular frequency
-
-        # iris impedance
-        tmp = np.sqrt((om/c)**2 - (pi/a)**2) + 0j
-        b_iris = 1.5*a*a/(self.d_iris/1000)**3 / tmp
-
-        tmp = (pi*c/a/om)**2 +0j
-        loss = self.loss_fac * np.sqrt(2*eps0*om*sc)/a * (1+tmp)/np.sqrt(1-tmp)
-
-        # cavity end part
-        gsq  = (pi/a)**2 - (om/c)**2 + 0j
-        gair = np.sqrt(gsq) +  loss + 0j
-        yrel = 1/np.tanh(gair*self.d1/1000)
-
-        # layer impedance
-        gsq = (pi/a)**2-self.layer_epsr*(om/c)**2 + (self.layer_sig*om*mu0) * 1j
-        glayer = np.sqrt(gsq) + loss
-        yrel *= gair/glayer
-        yrel = self._prop(yrel,glayer*self.layer_t/1000)
-
-        # substrate impedance
-        gsq = (pi/a)**2-self.sub_epsr*(om/c)**2 + (self.sub_sig*om*mu0) * 1j
-        gquartz = np.sqrt(gsq) + loss
-        yrel *= glayer/gquartz
-        yrel = self._prop(yrel,gquartz*self.sub_t/1000)
-
-        # iris cavity part
-        yrel *= gquartz/gair
-        yrel = self._prop(yrel,gair*d2/1000)
-        yrel -= b_iris*1j
-        ret = (1-yrel)/(1+yrel)
-        return( ret )
+        if self.precision == 'single' :
+            return( self._calc_single(freq_in_ghz) )
+        return( s11_complex(freq_in_ghz,self._params(),self._fcache,self._stack) )
+
+    def _calc_single(self,freq_in_ghz):
+        'the complex S11 in complex64, in double precision (returned as complex64) if the check fails'
+        p = self._params()
+        s = _s11(freq_in_ghz,_single(p,self._stack),_SingleTerms(),self._stack)
+        r = (s * s.conjugate()).real
+        k,sd,_ = _double_check(freq_in_ghz,p,r,stack=self._stack)
+        err = float(np.nanmax(np.abs((sd * sd.conjugate()).real - r[k])))
+        self._single_check = {'checks':1,'double':0,'max_err':err}
+        if not err <= SINGLE_TOL :
+            self._single_check['double'] = 1
+            s = _s11(freq_in_ghz,p,stack=self._stack).astype(np.complex64)
+        return( s )
+
+    _stack = S11_STACK # parameter names of the layers
+
+    def _params(self):
+        'the parameter mapping for the model functions'
+        return( vars(self) )
+
+    def params(self):
+        'the current parameters as S11Params record for the functional core (s11_complex, reflectivity)'
+        return( S11Params(**{k:getattr(self,k) for k in S11Params._fields}) )
+
+    def set_params(self,params):
+        'sets the parameters from a S11Params record (or a mapping with the same names)'
+        if isinstance(params,tuple):
+            params = params._asdict()
+        for k,v in params.items():
+            setattr(self,k,v)
+
+    @property
+    def stack(self):
+        'the (thickness,epsr,sigma) parameter names of the layers, the stack argument of s11_complex and reflectivity'
+        return( self._stack )
+
+    def _layer(self,layer):
+        'internal helper: the thickness and sigma names and the current values (mm, S/m) of a layer (index in stack)'
+        t_name,_,sig_name = self._stack[layer]
+        p = self._params()
+        return( t_name , sig_name , p[t_name] , p[sig_name] )
+
+    def param_names(self):
+        'names of the model parameters for jacobian() and sweep()'
+        return( JAC_PARAMS )
+
+    def jacobian(self,freq_in_ghz,wrt=None):
+        '''
+        exact derivatives of calc() with respect to the model parameters
+        wrt : parameter names, default are all of param_names()
+        returns an array of shape (len(freq_in_ghz) x len(wrt)), one column per parameter
+        '''
+        names = self.param_names()
+        if wrt is None :
+            wrt = names
+        for k in wrt:
+            assert k in names,f'no derivative for parameter <{k}>'
+        return( reflectivity_jac(freq_in_ghz,self._params(),wrt,self._fcache,self._stack)[1] )
+
+    def resonance(self,fmin,fmax,n_coarse=201,xtol=1e-9):
+        '''
+        locates the reflectivity minimum between fmin and fmax (GHz) and its half depth points
+        a coarse grid of n_coarse points brackets the minimum, it is refined with a bounded scalar
+        minimizer and the half depth points (1+R0)/2 are solved with brentq
+        returns {'f0','fwhm','Q','R0'} (f0,fwhm in GHz), fwhm is nan if a half depth point is outside fmin,fmax
+        '''
+        f = np.linspace(fmin,fmax,n_coarse)
+        y = self.calc(f)
+        k = int(np.nanargmin(y))
+        res = opt.minimize_scalar(lambda x: self.calc(x),bounds=(f[max(k-1,0)],f[min(k+1,n_coarse-1)]),
+                                  method='bounded',options={'xatol':xtol})
+        f0 = float(res.x)
+        r0 = float(self.calc(f0))
+        half = (1 + r0)/2
+        func = lambda x: self.calc(x) - half
+        left = np.nonzero(y[:k] > half)[0]
+        right = np.nonzero(y[k:] > half)[0]
+        fwhm = np.nan
+        if len(left) and len(right) :
+            fl = opt.brentq(func,f[left[-1]],f0,xtol=xtol)
+            fr = opt.brentq(func,f0,f[k+right[0]],xtol=xtol)
+            fwhm = fr - fl
+        return {'f0':f0,'fwhm':fwhm,'Q':f0/fwhm,'R0':r0}
+
+    def calc_adaptive(self,fmin,fmax,max_points=2000,tol=1e-3):
+        'the reflectivity on an adaptive frequency grid between fmin and fmax, see adaptive_grid()'
+        return( adaptive_grid(self.calc,fmin,fmax,max_points=max_points,tol=tol) )
+
+    def sweep(self,freq_in_ghz,complex_s11=False,precision=None,**params):
+        '''
+        evaluates the model for many parameter sets in one vectorized pass
+        params : any of param_names() as 1D arrays (all of the same length n) or scalars,
+                 parameters not given are taken from the instance
+        precision : 'double' or 'single' (float32/complex64 result), None uses the precision attribute.
+                    In single precision each block is checked near its deepest resonance and evaluated
+                    in double precision if the error is larger than SINGLE_TOL.
+        returns the (n x len(freq_in_ghz)) reflectivity grid (complex S11 if complex_s11 is set)
+        '''
+        n = 1
+        names = self.param_names()
+        for k,v in params.items():
+            assert k in names,f'unknown sweep parameter <{k}>'
+            v = np.ravel(v)
+            if v.size > 1 :
+                assert n == 1 or n == v.size,f'mismatched length of sweep parameter <{k}>'
+                n = v.size
+        p = dict(self._params())
+        for k,v in params.items():
+            p[k] = np.ravel(v).reshape(-1,1) # parameter axis x frequency axis
+        f = np.ravel(freq_in_ghz).reshape(1,-1)
+        single = (self.precision if precision is None else precision) == 'single'
+        s = np.empty((n,f.shape[1]),dtype=np.complex64 if single else complex)
+        step = max(1,_SWEEP_BLOCK // f.shape[1]) # work on cache sized blocks of parameter sets
+        check = {'checks':0,'double':0,'max_err':0.0}
+        for k in range(0,n,step):
+            pk = {key:(v[k:k+step] if key in params and v.shape[0] > 1 else v) for key,v in p.items()}
+            if not single :
+                s[k:k+step] = _s11(f,pk,stack=self._stack)
+                continue
+            sk = _s11(f,_single(pk,self._stack),_SingleTerms(),self._stack)
+            r = (sk * sk.conjugate()).real
+            i,sd,_ = _double_check(f,pk,r,stack=self._stack)
+            err = float(np.nanmax(np.abs((sd * sd.conjugate()).real - r[i])))
+            check['checks'] += 1
+            check['max_err'] = max(check['max_err'],err)
+            if not err <= SINGLE_TOL :
+                check['double'] += 1
+                sk = _s11(f,pk,stack=self._stack)
+            s[k:k+step] = sk
+        if single :
+            self._single_check = check
+        if complex_s11 :
+            return( s )
+        return( (s * s.conjugate()).real )
     
     def _prop_nonp(self,adm,gd):
         'internal helper function'
@@ -155,39 +505,187 @@ class S11ghz():
         ret = (1-yrel)/(1+yrel)
         return( ret )
     
-    def kfactor(self,freq_in_ghz,rel_change = 0.01): 
-        'calculate the k-factor using the current layer conductivity and solving for an incremental increase'
+    def _calc_with(self,freq_in_ghz,**changes):
+        'the reflectivity with some parameters changed, the instance is not modified'
+        p = dict(self._params())
+        p.update(changes)
+        s = _s11(freq_in_ghz,p,stack=self._stack)
+        return( (s * s.conjugate()).real )
+
+    def kfactor(self,freq_in_ghz,rel_change = 0.01,layer=0): 
+        '''
+        calculate the k-factor using the current layer conductivity and solving for an incremental increase
+        layer : index of the photoconductive layer in stack (S11ghz: 0 is the layer, 1 the substrate)
+        '''
         beta = self.a / self.b
         #beta = 2.24
-        tmp = self.layer_sig
-        back = self.layer_sig
+        t_name,sig_name,layer_t,layer_sig = self._layer(layer)
+        back = layer_sig
         if back == 0.0 :
             back = 1    
-        t_in_m = (self.layer_t*1e-3)
-        r0 = self.calc(freq_in_ghz)        
-        self.layer_sig *= (1 + rel_change) # increase the conductance
-        dg = (self.layer_sig - back) * t_in_m # change in conductivity
-        r1 = self.calc(freq_in_ghz)        
-        self.layer_sig = tmp
+        t_in_m = (layer_t*1e-3)
+        r0 = self._calc_with(freq_in_ghz) # double precision for the difference r1-r0
+        sig = layer_sig * (1 + rel_change) # increase the conductance
+        dg = (sig - back) * t_in_m # change in conductivity
+        r1 = self._calc_with(freq_in_ghz,**{sig_name:sig})
         kfac  = (r1-r0)/(r0*dg*beta)
         return( kfac )
 
-    def kfactor_abs(self,freq_in_ghz,delta_sig=0.1): 
-        'calculate the k-factor using the current layer conductivity and solving for an incremental increase'
+    def kfactor_abs(self,freq_in_ghz,delta_sig=0.1,layer=0): 
+        'calculate the k-factor using the current layer conductivity and solving for an incremental increase, see kfactor'
         beta = self.a / self.b
         #beta = 2.24  
-        tmp = self.layer_sig      
-        t_in_m = (self.layer_t*1e-3)
-        r0 = self.calc(freq_in_ghz)        
-        self.layer_sig += delta_sig # increase the conductance
+        t_name,sig_name,layer_t,layer_sig = self._layer(layer)
+        t_in_m = (layer_t*1e-3)
+        r0 = self._calc_with(freq_in_ghz) # double precision for the difference r1-r0
         dg = delta_sig * t_in_m # change in conductivity
-        r1 = self.calc(freq_in_ghz)        
-        self.layer_sig = tmp
+        r1 = self._calc_with(freq_in_ghz,**{sig_name:layer_sig + delta_sig}) # increase the conductance
         kfac  = (r1-r0)/(r0*dg*beta)
         return( kfac )
 
-
-
+    def kfactor_map(self,freq_in_ghz,layer_sig=None,layer_t=None,precision=None,layer=0):
+        '''
+        k-factor grid from the analytic derivative dR/dsigma (the limit of kfactor_abs for delta_sig -> 0)
+        freq_in_ghz,layer_sig,layer_t : scalars or 1D arrays, None uses the current value
+        precision : 'double' or 'single' (float32 result), None uses the precision attribute, see sweep.
+                    The single precision check uses the relative error of the k-factor (SINGLE_KTOL).
+        layer : index of the photoconductive layer in stack, layer_sig and layer_t are its conductivity and thickness
+        returns an array of shape (len(layer_t),len(layer_sig),len(freq_in_ghz)), the instance is not modified
+        '''
+        beta = self.a / self.b
+        t_name,sig_name,t0,sig0 = self._layer(layer)
+        sig = np.ravel(sig0 if layer_sig is None else layer_sig).reshape(1,-1,1)
+        t = np.ravel(t0 if layer_t is None else layer_t).reshape(-1,1,1)
+        f = np.ravel(freq_in_ghz).reshape(1,1,-1)
+        p = dict(self._params())
+        p[sig_name] = sig
+        p[t_name] = t
+        wrt = (sig_name,)
+        stack = self._stack
+        single = (self.precision if precision is None else precision) == 'single'
+        out = np.empty((t.shape[0],sig.shape[1],f.shape[2]),dtype=np.float32 if single else float)
+        step = max(1,_SWEEP_BLOCK // (sig.shape[1]*f.shape[2])) # cache sized blocks of thicknesses
+        check = {'checks':0,'double':0,'max_err':0.0}
+        for k in range(0,t.shape[0],step):
+            p[t_name] = t[k:k+step]
+            s,ds = _s11_jac(f,_single(p,stack),wrt,_SingleTerms(),stack) if single else _s11_jac(f,p,wrt,stack=stack)
+            r = (s * s.conjugate()).real
+            q = 2*(s.conjugate()*ds[sig_name]).real/r # dR/R per S/m
+            if single :
+                i,sd,dsd = _double_check(f,p,r,wrt,stack)
+                qd = 2*(sd.conjugate()*dsd[sig_name]).real/(sd * sd.conjugate()).real
+                err = float(np.nanmax(np.abs(qd - q[i]))/np.nanmax(np.abs(qd)))
+                check['checks'] += 1
+                check['max_err'] = max(check['max_err'],err)
+                if not err <= SINGLE_KTOL :
+                    check['double'] += 1
+                    s,ds = _s11_jac(f,p,wrt,stack=stack)
+                    q = 2*(s.conjugate()*ds[sig_name]).real/(s * s.conjugate()).real
+            out[k:k+step] = q/(t[k:k+step]*1e-3*beta)
+        if single :
+            self._single_check = check
+        return( out )
+
+
+
+
+
+class S11stack(S11ghz):
+    '''
+    cavity model with an arbitrary stack of layers, the cavity parameters are the ones of S11ghz
+    layers : list of (thickness in mm, epsr, sigma in S/m), ordered from the cavity end (d1 side)
+             to the iris side (d2 side). S11ghz is the 2 layer case [(layer_t,layer_epsr,layer_sig),(sub_t,sub_epsr,sub_sig)]
+    e.g. perovskite on ITO on glass: S11stack([(0.0005,6,0),(0.00015,4,5e5),(1,4.6,0)])
+    The layer parameters are named t0,epsr0,sig0,t1,... for jacobian(), sweep(), params() and set_params(),
+    they can also be read and set as attributes (s.sig1 = 1e3 updates layers). The layer attributes of
+    S11ghz (layer_t, sub_epsr ...) do not exist. The kfactor methods take the index of the photoconductive
+    layer (layer=...).
+    '''
+    def __init__(self,layers=()):
+        super().__init__()
+        for names in S11_STACK:
+            for name in names:
+                delattr(self,name)
+        self.layers = [tuple(x) for x in layers]
+
+    def _layer_index(self,name):
+        'internal helper: (layer index,index in (t,epsr,sig)) for a layer parameter name t0,epsr0,sig0,... or None'
+        for n,names in enumerate(self._stack):
+            if name in names :
+                return( n , names.index(name) )
+        return( None )
+
+    def __getattr__(self,name): # only called for names that are not found otherwise
+        if name != 'layers' and 'layers' in self.__dict__ :
+            k = self._layer_index(name)
+            if k is not None :
+                return( self.layers[k[0]][k[1]] )
+        raise AttributeError(f'S11stack has no attribute <{name}>')
+
+    def __setattr__(self,name,value):
+        if 'layers' in self.__dict__ : # after __init__
+            k = self._layer_index(name)
+            if k is not None :
+                layer = list(self.layers[k[0]])
+                layer[k[1]] = value
+                self.layers[k[0]] = tuple(layer)
+                return
+            if name in sum(S11_STACK,()) :
+                raise AttributeError(f'S11stack has no attribute <{name}>, the layer parameters are t0,epsr0,sig0,t1,...')
+        super().__setattr__(name,value)
+
+    @property
+    def _stack(self):
+        return( tuple((f't{k}',f'epsr{k}',f'sig{k}') for k in range(len(self.layers))) )
+
+    def _params(self):
+        p = dict(vars(self))
+        for names,layer in zip(self._stack,self.layers):
+            p.update(zip(names,layer))
+        return( p )
+
+    def param_names(self):
+        return( CAVITY_PARAMS + sum(self._stack,()) )
+
+    def params(self):
+        'the current parameters as dict (the number of parameters depends on the stack), use with stack=self.stack'
+        return( {k:v for k,v in self._params().items() if k in self.param_names() or k in ('a','b')} )
+
+    def _calc_nonumpy(self,freq_in_ghz):
+        assert 0,'_calc_nonumpy is the original 2 layer formula of S11ghz, not available for S11stack'
+
+
+def adaptive_grid(func,fmin,fmax,n_start=201,max_points=2000,tol=1e-3):
+    '''
+    samples func (e.g. S11ghz.calc) on a frequency grid that is refined where the curve bends
+    starting from n_start equidistant points, the intervals are split as long as the
+    midpoint value deviates by more than tol from the linear interpolation. The intervals
+    next to the minimum are always split, so that the resonance dip is resolved.
+    max_points : upper limit for the number of function evaluations
+    returns f,y (sorted arrays)
+    '''
+    f = np.linspace(fmin,fmax,n_start)
+    y = func(f)
+    df_min = (fmax - fmin)*1e-8 # no splitting below this resolution
+    todo = np.ones(len(f)-1,dtype=bool) # intervals to split
+    while len(f) < max_points :
+        k = np.nanargmin(y)
+        todo[max(k-1,0):k+1] = True
+        todo &= np.diff(f) > df_min
+        i = np.nonzero(todo)[0]
+        if len(i) == 0 :
+            break
+        i = i[:max_points-len(f)]
+        fm = (f[i] + f[i+1])/2
+        ym = func(fm)
+        err = np.abs(ym - (y[i] + y[i+1])/2)
+        # insert the midpoints, both halves of an interval inherit its error flag
+        f = np.insert(f,i+1,fm)
+        y = np.insert(y,i+1,ym)
+        flag = np.zeros(len(todo),dtype=bool)
+        flag[i] = err > tol
+        todo = np.repeat(flag,np.where(np.isin(np.arange(len(flag)),i),2,1))
+    return f , y
 
 
 def kfactor_simple(f0,fwhm,R0,c_l=0.048,c_w=0.0229,c_h=0.0102):    
@@ -250,4 +748,25 @@ if __name__ == "__main__":
     print(f[k])
 
     print(f'k-factor = {s.kfactor(f[k])}')
+
+    res = s.resonance(8.1,9.2)
+    print(res)
+    print(f"k-factor simple = {kfactor_simple(res['f0']*1e9,res['fwhm']*1e9,res['R0'])}")
+
+    # substrate thickness scan in one call: 200 thicknesses x len(f) frequencies
+    r = s.sweep(f,sub_t=np.linspace(0.5,1.5,200))
+    print(f'resonance vs sub_t : {f[r.argmin(axis=1)][[0,-1]]}')
+
+    # the same scan in single precision (half the memory), checked against double precision near the resonance
+    s.precision = 'single'
+    r32 = s.sweep(f,sub_t=np.linspace(0.5,1.5,200))
+    s.precision = 'double'
+    print(f'single precision : {r32.dtype}, max. error {np.abs(r32 - r).max():1.2g}, {s._single_check}')
+
+    # functional core: independent parameter records evaluated in a thread pool
+    import concurrent.futures
+    records = [s.params()._replace(sub_epsr=e) for e in np.linspace(3,4,16)]
+    with concurrent.futures.ThreadPoolExecutor(4) as ex :
+        r = list(ex.map(lambda p: reflectivity(f,p),records))
+    print(f'resonance vs sub_epsr : {f[np.argmin(r[0])]} {f[np.argmin(r[-1])]}')
     
\ No newline at end of file
@@ -18,9 +18,13 @@ The k-factor is calculated with the formulas below and by setting the 'layer' co
 ### usage tips
 * the position of the resonance peak is mainly defined by the cavity dimensions and by the sample/layer dieelectric constant and the thickness of the layers. 
 * The conductivity parameters of sample and cavity define the depth and width of the resonance curve
-* You can upload your microwave resonance curve for fitting by drag and drop to the upload area or by using the file selector. The format of the file needs to be 2 column text file (think csv,txt) with the first column beeing the frequency values in GHz.
-* Before you press fit, make sure that the model function peak has some overlap with the frequency range of your uploaded data! Otherwise the fit is likely to fail.
+* You can upload your microwave resonance curve for fitting by drag and drop to the upload area or by using the file selector. The format of the file needs to be 2 column text file (think csv,txt) with the first column beeing the frequency values in GHz. TDMS files are read directly: select the group, the frequency channel (or '(waveform properties)') and the S11 channel. For channels with several sweeps one sweep is read (sweep 0 by default), the points per sweep are found from the restart of the frequencies unless given.
+* Before you press fit, make sure that the model function peak has some overlap with the frequency range of your uploaded data! Otherwise the fit is likely to fail. If you are unsure, check 'multi-start fit': the fit is then started from many points within +/- span (sidebar) around the current values of the free parameters and the best result is kept.
 * a 'fixed' model parameter is held contant during the fit
+* by default only the data around the resonance dip is fitted ('crop to resonance' in the sidebar): the data is cropped to +/- n linewidths and the baseline is thinned out. This makes fits of long sweeps much faster. The plot and chisqr always use all data points.
+* the fit runs in the background: the progress (chisqr, parameter values) and the current fit curve are shown while it is running, 'cancel fit' stops it.
+* fit results are saved in a calibration store (~/.trmcapp/calibrations). Fitting the same data with the same start values and settings again (e.g. the empty cavity or substrate calibration of a previous session) returns the stored result immediately. Uncheck 'reuse stored fits' in the sidebar to force a new fit.
+* the results show the standard error of each free parameter and the correlation matrix, both from the jacobian at the solution (no extra fits). A warning is shown when the fit is ill conditioned, e.g. when d_iris, loss_fac and sub_epsr are fitted together on a single resonance and are strongly correlated. 'bootstrap errors' refits the model plus resampled residuals for an error estimate that does not assume gaussian noise.
 * The script makes use of a an unofficial session interface of streamlit that has some problems. Sometimes you have to click twice to see the actual result of a calculation. 
 * The default widget size is a bit 'Fisher Price' like... Decrease your browser windows zoom to make the widgets smaller (ctrl +/- or ctrl-mousewheel)
 * change the plot graph size in the sidebar
@@ -35,6 +39,8 @@ Fitting all model parameters using only the resonance curve for the sample loade
 1. upload the resonance curve for the empty cavity and fit 'loss_fac' and 'd_iris'. If needed try to fit d1 or d2 as well (not both at the same time!). The geometric quantities (d1,d2,d_iris) should not deviate much from the known values. Otherwise there is some issue with the data. 
 2. Upload the resonance curve measured with only the (glass) substrate in the cavity and fit the substrate epsilon (sub_epsr). The substrate thickness should be measured precisely and entered as a fixed value (sub_t). sub_sig = 0
 3. Upload the sample resonance curve and fit layer conductivty (layer_sig) with all other parameters fixed and layer_t set to the layer thickness. The layer_epsr does not play a role for very thin (<=1um) conductive layers and can be set to 1 or any other resonable value. If this fit works well the measurements seem to be consistent. If not, you may try to fit loss_fac and probably d_iris as well. Be aware however that this indicates that some uncontrolled changes of the cavity happened when you inserted your sample/substrate. 
+
+the three stages can also be run without the app: `python workflow.py empty.txt substrate.txt sample1.txt sample2.txt --set sub_t=1.1 layer_t=0.0005` fits them in order, each stage starting from the previous result. Stage results are cached, so for several samples on the same substrate only the sample stage is fitted again.
  
 
 
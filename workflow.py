@@ -0,0 +1,165 @@
+'''
+sequential calibration workflow for thin film samples (see the fitting strategy in trmcapp_help.py)
+
+the stages are fitted in order, each stage starts from the result of the previous one:
+1. empty cavity : loss_fac and d_iris
+2. substrate    : sub_epsr (sub_t set to the measured thickness)
+3. sample       : layer_sig (layer_t set to the layer thickness)
+
+a free parameter that an earlier stage set to a fixed value (e.g. sub_epsr=1 for the empty cavity)
+starts from the user value or the model default instead. A stage result is only accepted (and cached)
+when the rms deviation of the fit in the fit window is below max_rms.
+
+the key of a stage result contains the data hash and the start values, i.e. the result of the
+previous stage, so a stage is only refitted when its data or an earlier stage changed. With a
+series of samples on the same substrate only the sample stage is fitted for each sample.
+The results are kept in memory and, with store, in a calibration store (calstore.CalStore).
+
+usage:
+python workflow.py empty.txt substrate.txt sample1.txt sample2.txt --unit MHz --set sub_t=1.1 layer_t=0.0005
+'''
+import numpy as np
+
+import calstore
+import dataproc
+import s11fit
+from batchfit import read_curve
+from trmc_network import S11ghz
+
+# stage definitions: name, free parameters and fixed values set before the fit
+STAGES = (
+    {'name':'empty cavity','free':('d_iris','loss_fac'),'set':{'sub_epsr':1,'sub_sig':0,'layer_epsr':1,'layer_sig':0}},
+    {'name':'substrate','free':('sub_epsr',),'set':{'sub_sig':0}},
+    {'name':'sample','free':('layer_sig',),'set':{}},
+)
+
+
+class Workflow():
+    '''
+    stages : list of {'name','free','set'} dicts (see STAGES), any number of stages
+    values : start values {name : value}, e.g. measured thicknesses. The free parameters of a stage
+             start from these values (if given), all others from the result of the previous stage
+             (or from the model default, if an earlier stage set them)
+    window : fit only +/- window linewidths around the resonance (dataproc.fit_window), None for all points
+    max_rms : largest accepted rms deviation of the fit in the fit window (reflectivity units)
+    store : directory of a calibration store for the stage results, None keeps them in memory only
+    model : S11ghz instance for the waveguide dimensions
+    '''
+    def __init__(self,stages=STAGES,values=None,frequnit='GHz',german_num=False,window=5,store=None,model=None,max_rms=0.01):
+        self.stages = stages
+        self.values = {} if values is None else values
+        self.frequnit = frequnit
+        self.german_num = german_num
+        self.window = window
+        self.store = None if store is None else calstore.CalStore(store)
+        self.model = model
+        self.max_rms = max_rms
+        self._memo = {} # key -> stage result
+
+    def run(self,files,**fitargs):
+        '''
+        fits the files (one per stage) in order, each stage is warm started from the previous result
+        returns the list of stage results {'stage','file','status','chi2','cached','plist'},
+        stages after a failed stage get the status 'skipped'
+        '''
+        assert len(files) == len(self.stages),f'{len(self.stages)} files expected'
+        c = s11fit.new_fit(self.model)
+        for name,val in self.values.items():
+            c.set(name,val)
+        results = []
+        ok = True
+        forced = set() # parameters set by the earlier stages
+        for stage,fname in zip(self.stages,files):
+            res = {'stage':stage['name'],'file':str(fname),'status':'skipped','chi2':np.nan,'cached':False,'plist':None}
+            if ok :
+                res.update(self._run_stage(c,stage,fname,fitargs,forced))
+                ok = res['status'] == 'ok'
+            forced.update(stage['set'])
+            results.append(res)
+        return results
+
+    def _run_stage(self,c,stage,fname,fitargs,forced=()):
+        'fits a single stage, c holds the previous result and is updated with the result of this stage'
+        for name,val in stage['set'].items():
+            c.set(name,val)
+        default = S11ghz() if self.model is None else self.model
+        for name in stage['free']:
+            if name in self.values :
+                c.set(name,self.values[name])
+            elif name in forced : # the value set by an earlier stage is no start value
+                c.set(name,getattr(default,name))
+        for p in c.plist:
+            c.set(p['name'],p['val'],p['name'] not in stage['free'])
+        try:
+            data = read_curve(fname,self.frequnit,self.german_num)
+        except (OSError,ValueError,IndexError) as e:
+            return {'status':f'read error: {e}'}
+        dhash = calstore.data_hash(data[:,0],data[:,1])
+        # the stage is defined by the start values and fixed flags, so the key is the one of the app and batchfit
+        key = calstore.fit_key(dhash,c.plist,**calstore.fit_setup(self.window,**fitargs))
+        entry = self._memo.get(key)
+        if entry is None and self.store is not None :
+            entry = self.store.get(key)
+        if entry is not None :
+            calstore.apply(c,entry)
+            self._memo[key] = entry
+            return {'status':'ok','chi2':entry['chi2'],'cached':True,'plist':entry['plist']}
+        sel = slice(None) if self.window is None else dataproc.fit_window(data[:,0],data[:,1],n_widths=self.window)
+        try:
+            c.fit(data[:,0][sel],data[:,1][sel],**fitargs)
+        except (RuntimeError,ValueError):
+            return {'status':'fit did fail!'}
+        rms = np.sqrt(np.mean((c.calc(data[:,0][sel]) - data[:,1][sel])**2))
+        if not rms <= self.max_rms :
+            return {'status':f'poor fit (rms {rms:1.2g})','chi2':((c.calc(data[:,0]) - data[:,1])**2).sum()}
+        chi2 = ((c.calc(data[:,0]) - data[:,1])**2).sum()
+        if self.store is not None :
+            entry = self.store.put(key,c.plist,chi2,dhash,len(data),stage=stage['name'],file=str(fname))
+        else :
+            entry = {'plist':[dict(p) for p in c.plist],'chi2':chi2}
+        self._memo[key] = entry
+        return {'status':'ok','chi2':chi2,'cached':False,'plist':entry['plist']}
+
+    def run_series(self,files,samples,**fitargs):
+        '''
+        runs the workflow for each file in samples as last stage, files are the files of the other stages
+        returns a list with the result of the last stage for each sample
+        '''
+        return [self.run(list(files) + [s],**fitargs)[-1] for s in samples]
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import time
+    from batchfit import FREQ_SCALE,write_table
+
+    ap = argparse.ArgumentParser(description='calibration workflow: empty cavity -> substrate -> sample(s)')
+    ap.add_argument('empty',help='empty cavity resonance curve')
+    ap.add_argument('substrate',help='substrate resonance curve')
+    ap.add_argument('samples',nargs='+',help='sample resonance curves (all on the same substrate)')
+    ap.add_argument('--unit',default='GHz',choices=list(FREQ_SCALE),help='frequency unit of the data')
+    ap.add_argument('--german',action='store_true',help='decimal comma')
+    ap.add_argument('--set',nargs='*',default=[],help='start values as name=value, e.g. sub_t=1.1 layer_t=0.0005')
+    ap.add_argument('--window',type=float,default=5,help='fit only +/- WINDOW linewidths around the resonance')
+    ap.add_argument('--max-rms',type=float,default=0.01,help='largest accepted rms deviation of a stage fit')
+    ap.add_argument('--store',nargs='?',default=None,const=str(calstore.STORE_DIR),help='keep the stage results in a calibration store (directory)')
+    ap.add_argument('-o','--out',default='workflow.txt',help='result table')
+    args = ap.parse_args()
+
+    values = {}
+    for s in args.set:
+        name,val = s.split('=')
+        values[name] = float(val)
+    wf = Workflow(values=values,frequnit=args.unit,german_num=args.german,window=args.window,store=args.store,max_rms=args.max_rms)
+    t0 = time.perf_counter()
+    results = []
+    for s in args.samples:
+        for r in wf.run([args.empty,args.substrate,s]):
+            row = {k:v for k,v in r.items() if k != 'plist'}
+            for p in r['plist'] or []:
+                row[p['name']] = p['val']
+            results.append(row)
+            print(f"{r['stage']:15} {r['file']:30} {r['status']:10} cached={r['cached']}")
+    write_table(results,args.out)
+    print(f'{time.perf_counter()-t0:1.2f}s -> {args.out}')